@@ -0,0 +1,68 @@
+from money import Money
+
+
+def portfolio(positions, quotes, cash):
+    """
+    Value a user's positions at their quotes and work out the gains on them.
+
+    positions are holdings rows (symbol, shares, cost_basis and realized, in
+    cents), quotes maps each symbol to its quote or None and cash is Money.
+    Everything comes from the running totals kept in holdings, so the work
+    grows with the number of positions rather than the length of the ledger.
+
+    Returns a dict of the open positions (with their price, value, cost
+    basis, unrealized and realized gain and return) and the portfolio's
+    totals. A position with no quote right now has None for its price and
+    the figures that depend on it, and is left out of the totals.
+    """
+    rows = []
+    value = Money(0)
+    costBasis = Money(0)
+    unrealized = Money(0)
+    realized = Money(0)
+
+    for position in positions:
+        positionRealized = Money(position["realized"])
+        realized += positionRealized
+
+        # Positions sold off entirely only count towards the realized gain
+        if position["shares"] <= 0:
+            continue
+
+        quote = quotes.get(position["symbol"])
+        positionCost = Money(position["cost_basis"])
+        row = {
+            "symbol": position["symbol"],
+            "name": quote["name"] if quote else "",
+            "shares": position["shares"],
+            "price": None,
+            "value": None,
+            "cost_basis": positionCost,
+            "unrealized": None,
+            "realized": positionRealized,
+            "return": None,
+        }
+
+        if quote:
+            row["price"] = Money.from_dollars(quote["price"])
+            row["value"] = row["price"] * position["shares"]
+            row["unrealized"] = row["value"] - positionCost
+            if positionCost:
+                row["return"] = row["unrealized"].cents / positionCost.cents
+
+            value += row["value"]
+            costBasis += positionCost
+            unrealized += row["unrealized"]
+
+        rows.append(row)
+
+    return {
+        "positions": rows,
+        "cash": cash,
+        "value": value,
+        "total": value + cash,
+        "cost_basis": costBasis,
+        "unrealized": unrealized,
+        "realized": realized,
+        "total_return": unrealized + realized,
+    }
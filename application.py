@@ -1,130 +1,377 @@
+import csv
+import io
+import json
+import math
 import os
-import locale  # added for formatting currency
-import requests  # added for AJAX request
-import re  # added for regex
+import threading
+import time
 
 from dotenv import load_dotenv
-load_dotenv()
-
-# cs50 import statement 
-from cs50 import SQL
 
 # flask specific import statements
-from flask import Flask, flash, redirect, render_template, request, session, jsonify  # jsonify was added here
-from flask_session import Session
-from tempfile import mkdtemp
+import click
+from flask import Blueprint, Flask, Response, current_app, flash, redirect, render_template, request, session, jsonify, stream_with_context  # jsonify was added here
 from werkzeug.exceptions import default_exceptions, HTTPException, InternalServerError
-from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.local import LocalProxy
 
 # imports from helpers.py file
-from helpers import apology, login_required, lookup, usd
+from helpers import apology, cents, etag_cached, every, fetch_symbols, login_required, lookup, lookup_many, static_url, usd
+from money import Money
+from symbols import SymbolDirectory
+from ticker import PriceTicker
+import analytics
+import holdings
+import metrics
+import migrations
+import orders
+import passwords
+import repository
+import sessions
+import snapshots
+import statements
+import trades
+
+# Transactions shown per page of history, by default and at most
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+
+# Transactions read from the database at a time while exporting history
+EXPORT_CHUNK = 1000
+
+# Most orders accepted in one batch
+MAX_BATCH_ORDERS = 100
+
+# Limit and stop orders listed on the orders page
+ORDERS_SHOWN = 100
+
+# Users shown per page of the leaderboard, and symbols shown beside them
+LEADERBOARD_PAGE_SIZE = 50
+LEADERBOARD_SYMBOLS = 20
+
+# Seconds between comments sent down an idle price stream to keep the connection open
+STREAM_KEEPALIVE = 15
+
+# Seconds a price stream stays open before the browser is told to reconnect, so no worker is held forever
+STREAM_LIFETIME = 300
+
+# Every route and command of the application, registered on the app by create_app()
+bp = Blueprint("finance", __name__, cli_group=None)
+
+
+def create_app(config=None):
+    """
+    Create and configure the application.
+
+    Settings are read from the environment (and .env), then overridden by
+    the config dict if one is given, such as {"DATABASE": "test.db"}. Only
+    cheap work happens here: the database connection, the symbol list and
+    the order matcher are created when first used, and the background jobs
+    start with each process's first request, so that forked workers boot
+    quickly and each run their own.
+    """
+    load_dotenv()
+
+    # Configure application
+    app = Flask(__name__)
+    app.config.update(
+        DATABASE=os.environ.get("DATABASE", "finance.db"),
+        SESSION_BACKEND=os.environ.get("SESSION_BACKEND", "sqlite"),
+        SESSION_DATABASE=os.environ.get("SESSION_DATABASE", "sessions.db"),
+        SECRET_KEY=os.environ.get("SECRET_KEY"),
+        PROFILE_SLOW_REQUESTS=float(os.environ.get("PROFILE_SLOW_REQUESTS", 0)) or None,
+        PROFILE_DIR=os.environ.get("PROFILE_DIR", "profiles"),
+        METRICS_TOKEN=os.environ.get("METRICS_TOKEN"),
+        BACKGROUND_JOBS=True,
+        ORDER_MATCHING=os.environ.get("ORDER_MATCHING", "on") != "off",
+        ORDER_MATCH_INTERVAL=float(os.environ.get("ORDER_MATCH_INTERVAL", 5)),
+        CHECKPOINT_INTERVAL=float(os.environ.get("CHECKPOINT_INTERVAL", 60 * 60)),
+        PRICE_STREAM_INTERVAL=float(os.environ.get("PRICE_STREAM_INTERVAL", 5)),
+        LEADERBOARD_INTERVAL=float(os.environ.get("LEADERBOARD_INTERVAL", 24 * 60 * 60)),
+
+        # Passwords are hashed in PASSWORD_HASH_WORKERS processes (0 hashes in the request thread), and logins
+        # beyond PASSWORD_HASH_QUEUE waiting hashes, or LOGIN_ATTEMPTS per LOGIN_WINDOW seconds from one address
+        # or for one username, are turned away with a 429
+        PASSWORD_HASH_METHOD=os.environ.get("PASSWORD_HASH_METHOD", passwords.HASH_METHOD),
+        PASSWORD_HASH_WORKERS=int(os.environ.get("PASSWORD_HASH_WORKERS", 2)),
+        PASSWORD_HASH_QUEUE=int(os.environ.get("PASSWORD_HASH_QUEUE", 16)),
+        LOGIN_ATTEMPTS=int(os.environ.get("LOGIN_ATTEMPTS", 10)),
+        LOGIN_WINDOW=float(os.environ.get("LOGIN_WINDOW", 60)),
+
+        # Reload templates when they change only in debug mode; otherwise every render checks the files
+        TEMPLATES_AUTO_RELOAD=None,
+
+        # Let browsers keep static files for a year; static_url() changes their URLs when they change
+        SEND_FILE_MAX_AGE_DEFAULT=365 * 24 * 60 * 60,
+    )
+    app.config.update(config or {})
+
+    # Make sure API key is set, unless quotes come from the offline fake provider
+    if not os.environ.get("API_KEY") and os.environ.get("QUOTE_PROVIDER", "iex") != "fake":
+        raise RuntimeError("API_KEY not set")
+
+    # Custom filters; amounts of money are formatted by the templates, as Money with usd or as stored cents with cents
+    app.jinja_env.filters["usd"] = usd
+    app.jinja_env.filters["cents"] = cents
+    app.jinja_env.globals["static_url"] = static_url
+
+    # Keep sessions in a SQLite file every worker shares, or with SESSION_BACKEND=cookie in signed cookies
+    if app.config["SESSION_BACKEND"] == "cookie":
+        if not app.config["SECRET_KEY"]:
+            raise RuntimeError("SECRET_KEY not set")
+    else:
+        app.session_interface = sessions.SQLiteSessionInterface(app.config["SESSION_DATABASE"])
+
+    # Time every request (see /metrics and the Server-Timing header) and, if PROFILE_SLOW_REQUESTS
+    # is set to a number of milliseconds, save a profile of every request slower than that
+    metrics.init_app(app, slow_request_ms=app.config["PROFILE_SLOW_REQUESTS"], profile_dir=app.config["PROFILE_DIR"],
+                     token=app.config["METRICS_TOKEN"])
+
+    # Let page views read while a trade is being written
+    trades.enable_wal(app.config["DATABASE"])
+
+    # Bring the database schema up to date
+    migrations.migrate(app.config["DATABASE"])
+
+    app.register_blueprint(bp)
+    app.teardown_appcontext(close_database)
+
+    # Listen for errors
+    for code in default_exceptions:
+        app.errorhandler(code)(errorhandler)
+
+    return app
+
+
+# Guards the creation of each app's database handle, symbol list, order matcher, price ticker and password hasher
+_resourceLock = threading.RLock()
+
+
+def _resource(name, create):
+    """Return the current app's resource called name, calling create() to make it the first time"""
+    extensions = current_app.extensions
+    if name not in extensions:
+        with _resourceLock:
+            if name not in extensions:
+                extensions[name] = create()
+    return extensions[name]
+
+
+def get_db():
+    """Return the app's database handle, connecting on first use"""
+    def connect():
+        # Importing the CS50 library loads SQLAlchemy, which takes a while, so it waits until needed
+        from cs50 import SQL
+        return metrics.InstrumentedSQL(SQL(f"sqlite:///{current_app.config['DATABASE']}"))
+
+    return _resource("finance.db", connect)
+
+
+def get_repository():
+    """Return the app's queries on users, transactions and holdings"""
+    return _resource("finance.repository", lambda: repository.Repository(current_app.config["DATABASE"]))
+
+
+# Configure CS50 Library to use SQLite database; trades and background jobs write through it
+db = LocalProxy(get_db)
+
+# The routes' own reads (and registrations) go straight to sqlite3
+repo = LocalProxy(get_repository)
+
+# Keep the list of stock symbols in finance.db and refresh it once a day
+symbolDirectory = LocalProxy(lambda: _resource("finance.symbols", lambda: SymbolDirectory(get_db(), fetch_symbols)))
 
-from datetime import datetime  # added to get date & time
+# Fill limit and stop orders as prices reach them
+orderMatcher = LocalProxy(lambda: _resource("finance.orders", lambda: orders.OrderMatcher(get_db(), lookup_many)))
 
-# Configure application
-app = Flask(__name__)
+# Poll the prices of the stocks on everyone's open portfolio page in one go
+priceTicker = LocalProxy(lambda: _resource("finance.ticker", lambda: PriceTicker(
+    lookup_many, interval=current_app.config["PRICE_STREAM_INTERVAL"])))
 
-# Ensure templates are auto-reloaded
-app.config["TEMPLATES_AUTO_RELOAD"] = True
 
-# Ensure responses aren't cached
+def get_password_hasher():
+    """Return the app's password hasher, whose worker processes start with the first hash"""
+    def create():
+        config = current_app.config
+        hasher = passwords.PasswordHasher(config["PASSWORD_HASH_METHOD"], workers=config["PASSWORD_HASH_WORKERS"],
+                                          max_pending=config["PASSWORD_HASH_QUEUE"])
+        metrics.metrics.collect("password_hasher", hasher.stats, gauges=["pending"])
+        return hasher
 
+    return _resource("finance.passwords", create)
 
-@app.after_request
+
+# Hash and check passwords away from the request threads
+passwordHasher = LocalProxy(get_password_hasher)
+
+# Count login and registration attempts by address and by username
+loginThrottle = LocalProxy(lambda: _resource("finance.throttle", lambda: passwords.Throttle(
+    current_app.config["LOGIN_ATTEMPTS"], current_app.config["LOGIN_WINDOW"])))
+
+
+@bp.before_app_request
+def start_background_jobs():
+    """Start this process's background jobs, unless they already run here"""
+    app = current_app._get_current_object()
+    if not app.config["BACKGROUND_JOBS"] or app.extensions.get("finance.jobs") == os.getpid():
+        return
+
+    # Jobs are tied to the process that started them, since threads don't survive a fork
+    with _resourceLock:
+        if app.extensions.get("finance.jobs") == os.getpid():
+            return
+        app.extensions["finance.jobs"] = os.getpid()
+
+        every(60 * 60, symbolDirectory.refresh_if_stale, "symbol-refresh")
+
+        # Snapshot the positions of users who have traded since the last checkpoint
+        database = get_db()
+        every(app.config["CHECKPOINT_INTERVAL"], lambda: snapshots.checkpoint(database), "ledger-checkpoint")
+
+        # Workers check every hour and only one of them recomputes rankings that have gone stale
+        every(60 * 60, lambda: refresh_leaderboard_if_stale(app), "leaderboard")
+
+        # Set ORDER_MATCHING=off in all but one worker to leave the matching to that one
+        if app.config["ORDER_MATCHING"]:
+            every(app.config["ORDER_MATCH_INTERVAL"], orderMatcher.tick, "order-matcher")
+
+
+def refresh_leaderboard_if_stale(app):
+    """Recompute the leaderboard if it is older than LEADERBOARD_INTERVAL"""
+    # numpy takes a while to import, so the leaderboard module waits for the first run of the job
+    import leaderboard
+    leaderboard.refresh_if_stale(app.config["DATABASE"], lookup_many, app.config["LEADERBOARD_INTERVAL"])
+
+
+# Ensure responses aren't cached, unless the route or static file handler has said otherwise
+@bp.after_app_request
 def after_request(response):
+    if "Cache-Control" in response.headers:
+        return response
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
     return response
 
 
-# Custom filter
-app.jinja_env.filters["usd"] = usd
-
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_FILE_DIR"] = mkdtemp()
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
-
-# Configure CS50 Library to use SQLite database
-db = SQL("sqlite:///finance.db")
+# Once a transaction has been started the CS50 library keeps each thread's connection open,
+# and it can't register its own teardown after the first request, so create_app() closes it with this
+def close_database(exception):
+    """Return the request's database connection to the pool"""
+    if "finance.db" in current_app.extensions:
+        db._disconnect()
 
-# Make sure API key is set
-if not os.environ.get("API_KEY"):
-    raise RuntimeError("API_KEY not set")
 
-# Code to see locale options
-# for lang in locale.windows_locale.values():
-#     print(lang)
+def too_many_requests(message, retryAfter):
+    """Render message as a 429 apology telling the client to retry after some seconds"""
+    body, code = apology(message, 429)
+    return body, code, {"Retry-After": str(max(1, math.ceil(retryAfter)))}
 
-# Set locale for USD currency format
-locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
 
+def ledger_version():
+    """Return a tag for the current user's ledger that changes with every transaction"""
+    userID = session["user_id"]
+    return f"{userID}.{repo.ledger_version(userID)}"
 
-@app.route("/")
-@login_required
-def index():
-    """Show portfolio of stocks"""
-
-    # print(datetime.now())
 
-    # Find the user ID of the current user
-    userID = session["user_id"]
+def json_dollars(amount):
+    """Return Money as the plain decimal string of dollars the JSON routes give, such as "1234.56", or None"""
+    return None if amount is None else str(amount.dollars)
 
-    # Query all the transactions of the user
-    transactions = db.execute("SELECT SUM(shares_count) total_shares, stock_symbol \
-                              FROM (SELECT * FROM transactions WHERE user_id = ? AND stock_symbol != ?) GROUP BY stock_symbol",
-                              userID, "DEPOSIT")
 
-    # print(transactions)
+def summarize_portfolio(userID):
+    """Value the user's positions at current quotes and work out the gains on them"""
 
-    # Set variable to be summed over
-    grandStockTotal = 0
+    # Query the positions the user holds, including those sold off for their realized gains
+    positions = repo.positions(userID)
 
-    # Iterate through the total shares for each stock type
-    # Transaction is a dictionary with the keys "total_shares"and "stock_symbol"
-    # Add more information about each stock type to the dictionaries
-    for transaction in transactions:
-        # print(transaction)
+    # Fetch the quotes for every held stock in one go
+    quotes = lookup_many([position["symbol"] for position in positions if position["shares"] > 0])
 
-        dictLookup = lookup(transaction["stock_symbol"])
+    # Get total cash available in the user's account
+    cash = Money(repo.cash(userID))
 
-        # Find the company's name given the symbol for the transaction aggregate row
-        # Add a "company_name" key
-        transaction["company_name"] = dictLookup["name"]
+    return analytics.portfolio(positions, quotes, cash)
 
-        # Find the CURRENT price of the stock
-        currentPrice = dictLookup["price"]
 
-        # Add a "current_stock_price" key
-        transaction["current_stock_price"] = locale.currency(currentPrice, grouping=True)
+@bp.route("/")
+@login_required
+def index():
+    """Show portfolio of stocks"""
 
-        # Calculate the total value of the stocks
-        totalStockValue = currentPrice * transaction["total_shares"]
+    # Find the user ID of the current user
+    userID = session["user_id"]
 
-        # Add a "total_stock_value" key
-        transaction["total_stock_value"] = locale.currency(totalStockValue, grouping=True)
+    summary = summarize_portfolio(userID)
 
-        # Update the grand total of stocks
-        grandStockTotal += totalStockValue
+    # The template formats the amounts, leaving blanks where no quote is available right now
+    return render_template("index.html", positions=summary["positions"], summary=summary)
 
-        # print(transaction)
-        # print(totalStockValue, grandStockTotal)
 
-    # Get total cash available in the user's account
-    totalCash = db.execute("SELECT cash FROM users WHERE id=?", userID)[0]["cash"]
+@bp.route("/portfolio")
+@login_required
+def portfolio():
+    """Show the user's positions, gains and returns as JSON"""
+
+    summary = summarize_portfolio(session["user_id"])
+
+    # Amounts are given in dollars, returns as fractions of the cost basis
+    positions = []
+    for position in summary["positions"]:
+        positions.append({
+            "symbol": position["symbol"],
+            "name": position["name"],
+            "shares": position["shares"],
+            "price": json_dollars(position["price"]),
+            "value": json_dollars(position["value"]),
+            "cost_basis": json_dollars(position["cost_basis"]),
+            "unrealized": json_dollars(position["unrealized"]),
+            "realized": json_dollars(position["realized"]),
+            "return": None if position["return"] is None else round(position["return"], 6)
+        })
+
+    return jsonify({"positions": positions,
+                    **{key: json_dollars(summary[key]) for key in
+                       ["cash", "value", "total", "cost_basis", "unrealized", "realized", "total_return"]}})
+
+
+@bp.route("/prices/stream")
+@login_required
+def price_stream():
+    """Push price changes for the user's stocks as server-sent events"""
 
-    grandStockTotal += totalCash
+    userID = session["user_id"]
 
-    # Format the cash and total values as currencies to be viewed in the table
-    cash = locale.currency(totalCash, grouping=True)
-    total = locale.currency(grandStockTotal, grouping=True)
+    # Only the stocks the user holds are watched
+    symbols = repo.held_symbols(userID)
 
-    return render_template("index.html", transactions=transactions, cash=cash)
+    # Nothing to watch; 204 tells the browser not to reconnect
+    if not symbols:
+        return Response(status=204)
 
+    # The generator runs after the view has returned, outside the app context the proxy needs
+    ticker = priceTicker._get_current_object()
 
-@app.route("/buy", methods=["GET", "POST"])
+    def events():
+        subscription = ticker.subscribe(symbols)
+        closing = time.monotonic() + STREAM_LIFETIME
+        try:
+            # The browser waits this many milliseconds before reconnecting once the stream ends
+            yield f"retry: {STREAM_KEEPALIVE * 1000}\n\n"
+            while time.monotonic() < closing:
+                changes = subscription.wait(STREAM_KEEPALIVE)
+                if changes:
+                    yield f"event: prices\ndata: {json.dumps(changes)}\n\n"
+                else:
+                    yield ": keepalive\n\n"
+        finally:
+            # Runs when the browser disconnects and the server closes the generator
+            ticker.unsubscribe(subscription)
+
+    # Ask proxies not to buffer the stream
+    return Response(events(), mimetype="text/event-stream", headers={"X-Accel-Buffering": "no"})
+
+
+@bp.route("/buy", methods=["GET", "POST"])
 @login_required
 def buy():
     """Buy shares of stock"""
@@ -164,40 +411,16 @@ def buy():
 
         # Extract information about the stock
         companyName = dictLookup["name"]
-        stockPrice = dictLookup["price"]
+        stockPrice = Money.from_dollars(dictLookup["price"])
 
         # Get the user's ID
         userID = session["user_id"]
-        # print(userID)
-
-        # Store the amount of cash the user has
-        totalCash = db.execute("SELECT cash FROM users WHERE id=?", userID)[0]["cash"]
-
-        # Check to see if the user can afford the stock purchase
-        totalCost = stockPrice * shares
-
-        if totalCost > totalCash:
-            return apology("The user does not have sufficient funds to make the purchase.")
-
-        # Calculate account balance
-        balance = totalCash - totalCost
-
-        # Account for errors in floating-point subtraction
-        balance = (int(balance * 100)) / 100
-
-        # print(f"\ntotal cash: {totalCash}")
-        # print(f"total cost: {totalCost}")
-        # print(f"balance after purchase: {balance}\n")
-
-        # Update the cash amount in the users table
-        db.execute("UPDATE users SET cash=? WHERE id=?", balance, userID)
-
-        # Get the current date & time
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # Store the transaction data in the transactions table
-        db.execute("INSERT INTO transactions(user_id, stock_symbol, shares_count, cost, time) VALUES(?, ?, ?, ?, ?)",
-                   userID, symbol, shares, stockPrice, now)
+        # Pay for the shares, checking the user can afford them in the same transaction
+        try:
+            trades.buy(db, userID, symbol, shares, stockPrice)
+        except trades.TradeError as e:
+            return apology(str(e))
 
         # Flash the message to be passed to the index page
         flash(f"{shares} {symbol} share(s) purchased!")
@@ -208,7 +431,8 @@ def buy():
         return render_template("buy.html")
 
 
-@app.route("/deposit", methods=["GET", "POST"])
+@bp.route("/deposit", methods=["GET", "POST"])
+@login_required
 def deposit():
     """Allow user to add cash."""
 
@@ -216,91 +440,248 @@ def deposit():
         # Extract cash amount from the form
         dollarsToAdd = request.form.get("deposit amount")
 
-        # Check if the cash is a float
+        # Check if the cash is a valid amount to the nearest hundredths place
         try:
-            dollarsToAdd = float(dollarsToAdd)
-        except TypeError:
-            return apology("A valid currency number should be entered.")
+            dollarsToAdd = Money.parse(dollarsToAdd)
+        except ValueError:
+            return apology("A valid currency amount to the nearest hundredths place must be entered.")
 
-        # Make sure the number entered is accurate to the nearest thousandths place
-        thousandFold = dollarsToAdd * 1000
-        remainder = thousandFold % 10
+        # Check if the cash is a positive amount
+        if dollarsToAdd <= 0:
+            return apology("The deposit amount must be more than $0.00.")
 
-        print(dollarsToAdd, remainder)
+        # Add the deposit to the cash balance and the transactions table
+        userID = session["user_id"]
+        trades.deposit(db, userID, dollarsToAdd)
 
-        # Check if the cash is properly formatted
-        if remainder != 0:
-            return apology("A valid currency amount to the nearest hundredths place must be entered.")
+        # Flash the message to be passed to the index page
+        flash(f"{dollarsToAdd} deposited!")
 
-        # Get the user's current balance
+        return redirect("/")
+    else:
+        # Get the user's ID
         userID = session["user_id"]
-        currentCash = db.execute("SELECT cash FROM users WHERE id=?", userID)[0]["cash"]
 
-        # Calculate the total cash after the deposit
-        updatedCash = currentCash + dollarsToAdd
+        # Get the user's current balance
+        cash = Money(repo.cash(userID))
 
-        # Account for errors in floating-point addition
-        updatedCash = (int(updatedCash * 100)) / 100
+        return render_template("deposit.html", cash=cash)
 
-        # Check totals before updating tables
-        print("\ncurrent cash: %f\nmoney added: %f\nupdated cash: %f\n" % (currentCash, dollarsToAdd, updatedCash))
 
-        # return apology("Test before updating finance.db tables")
+@bp.route("/orders", methods=["GET", "POST"])
+@login_required
+def limit_orders():
+    """Place limit and stop orders and list the user's orders"""
 
-        # Update the cash balance
-        db.execute("UPDATE users SET cash=? WHERE id=?", updatedCash, userID)
+    userID = session["user_id"]
 
-        # Get the current time
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if request.method == "POST":
+        symbol = (request.form.get("symbol") or "").upper()
+        side = request.form.get("side")
+        kind = request.form.get("kind")
+        shares = request.form.get("shares")
+        price = request.form.get("price")
 
-        # Add the deposit to the transactions table
-        db.execute("INSERT INTO transactions(user_id, stock_symbol, cost, shares_count, time) VALUES(?, ?, ?, ?, ?)",
-                   userID, "DEPOSIT", dollarsToAdd, 0, now)
+        # Check every field of the order form
+        if not symbol:
+            return apology("No symbol was entered.")
+        if side not in orders.SIDES:
+            return apology("The order must be to buy or to sell.")
+        if kind not in orders.KINDS:
+            return apology("The order must be a limit or a stop order.")
+        try:
+            shares = int(shares)
+        except (TypeError, ValueError):
+            return apology("A valid integer amount of shares must be entered.")
+        if shares < 1:
+            return apology("The shares amount must be 1 or more.")
+        try:
+            price = Money.parse(price)
+        except (AttributeError, ValueError):
+            return apology("A valid price to the nearest hundredths place must be entered.")
+        if price <= 0:
+            return apology("The price must be more than $0.00.")
 
-        # Flash the message to be passed to the index page
-        flash(f"${dollarsToAdd:,.2f} deposited!")
+        # Make sure the symbol can be quoted, so the order can ever fill
+        if not lookup(symbol):
+            return apology("The symbol \"" + symbol + "\" does not exist.")
 
-        return redirect("/")
-    else:
-        # Get the user's ID
-        userID = session["user_id"]
+        orders.place(db, userID, symbol, side, kind, shares, price)
+        flash(f"{kind.capitalize()} order to {side} {shares} {symbol} share(s) at {price} placed!")
+        return redirect("/orders")
 
-        # Get the user's current balance
-        currentCash = db.execute("SELECT cash FROM users WHERE id=?", userID)[0]["cash"]
-        print("current cash balance: %f" % (currentCash))
+    return render_template("orders.html", orders=repo.orders_page(userID, ORDERS_SHOWN))
 
-        # Format the currency
-        cash = locale.currency(currentCash, grouping=True)
 
-        return render_template("deposit.html", cash=cash)
+@bp.route("/orders/<int:orderID>/cancel", methods=["POST"])
+@login_required
+def cancel_order(orderID):
+    """Cancel one of the user's open orders"""
+
+    if not orders.cancel(db, session["user_id"], orderID):
+        return apology("The order is no longer open.")
+
+    # Stop this worker's matcher from trying to fill it; with matching off there's no matcher to tell
+    if current_app.config["ORDER_MATCHING"]:
+        orderMatcher.book.remove(orderID)
+
+    flash("Order cancelled!")
+    return redirect("/orders")
 
 
-@app.route("/history")
+@bp.route("/history")
 @login_required
+@etag_cached(ledger_version)
 def history():
     """Show history of transactions"""
 
     # Find the user ID of the current user
     userID = session["user_id"]
 
-    # Query all the transactions of the user
-    transactionHistory = db.execute("SELECT * FROM transactions WHERE user_id=?", userID)
+    # Get the number of transactions to show per page
+    try:
+        perPage = min(max(int(request.args.get("per_page", HISTORY_PAGE_SIZE)), 1), MAX_HISTORY_PAGE_SIZE)
+    except ValueError:
+        return apology("The page size must be a whole number.")
 
-    #print("User " + str(userID) +"'s transaction history:")
+    # Query one page of the user's transactions, newest first
+    # "before" holds the time and number of the last transaction on the previous page
+    before = request.args.get("before")
+    if before:
+        try:
+            beforeTime, beforeNo = before.rsplit("|", 1)
+            beforeNo = int(beforeNo)
+        except ValueError:
+            return apology("Invalid page.")
+        transactionHistory = repo.history_page(userID, perPage + 1, (beforeTime, beforeNo))
+    else:
+        transactionHistory = repo.history_page(userID, perPage + 1)
 
-    for transaction in transactionHistory:
-        # Replace the "cost" value in the dictionaries with currency-formatted version
-        transaction["cost"] = locale.currency(transaction["cost"], grouping=True)
+    # The extra row only tells us whether there is an older page
+    nextPage = None
+    if len(transactionHistory) > perPage:
+        transactionHistory = transactionHistory[:perPage]
+        last = transactionHistory[-1]
+        nextPage = f"{last['time']}|{last['transaction_no']}"
 
-        if transaction["stock_symbol"] == "DEPOSIT":
-            transaction["shares_count"] = ""
+    # The template formats each price from its cents as it renders the row
+    return render_template("history.html", transactions=transactionHistory, nextPage=nextPage,
+                           firstPage=not before, perPage=perPage)
 
-        # print(transaction)
 
-    return render_template("history.html", transactions=transactionHistory)
+@bp.route("/history/export")
+@login_required
+def export_history():
+    """Download the full history of transactions as CSV or NDJSON"""
 
+    userID = session["user_id"]
+    exportFormat = request.args.get("format", "csv")
+
+    if exportFormat not in ["csv", "ndjson"]:
+        return apology("The export format must be csv or ndjson.")
+
+    def rows():
+        """Yield the user's transactions, oldest first, a chunk at a time."""
+        # Transactions moved to the archive come first
+        for data in repo.archived(userID):
+            yield from snapshots.unpack(data)
+
+        chunk = repo.ledger(userID, EXPORT_CHUNK)
+        while chunk:
+            yield from chunk
+            last = chunk[-1]
+            chunk = repo.ledger(userID, EXPORT_CHUNK, (last["time"], last["transaction_no"]))
+
+    def generate():
+        if exportFormat == "csv":
+            yield "transaction_no,time,symbol,shares,price\r\n"
+        for row in rows():
+            price = str(Money(row["cost"]).dollars)
+            if exportFormat == "csv":
+                line = io.StringIO()
+                csv.writer(line).writerow([row["transaction_no"], row["time"], row["stock_symbol"], row["shares_count"], price])
+                yield line.getvalue()
+            else:
+                yield json.dumps({"transaction_no": row["transaction_no"], "time": row["time"], "symbol": row["stock_symbol"],
+                                  "shares": row["shares_count"], "price": price}) + "\n"
+
+    mimetype = "text/csv" if exportFormat == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename=history.{exportFormat}"})
+
+
+@bp.route("/history/import", methods=["GET", "POST"])
+@login_required
+def import_history():
+    """Add the trades and deposits in a brokerage statement to the user's history"""
+
+    if request.method == "POST":
+        statement = request.files.get("statement")
+        if not statement or not statement.filename:
+            return apology("No statement has been chosen.")
+
+        # Uploads are read straight from the temporary file werkzeug keeps them in
+        file = io.TextIOWrapper(statement.stream, encoding="utf-8-sig", errors="replace", newline="")
+        try:
+            count = statements.import_statement(current_app.config["DATABASE"], session["user_id"], file,
+                                                statement.filename, symbolDirectory)
+        except statements.StatementError as e:
+            return apology(str(e))
+
+        flash(f"{count} transaction(s) imported!")
+        return redirect("/history")
+
+    else:
+        return render_template("import.html")
+
+
+@bp.route("/history/value")
+@login_required
+def history_value():
+    """Show the daily value of the user's portfolio as JSON"""
+
+    userID = session["user_id"]
+
+    # numpy takes a while to import, so prices is only loaded by the routes and commands that use it
+    import prices
+
+    # Replay the ledger against the stored closing prices
+    try:
+        dates, values = prices.portfolio_values(current_app.config["DATABASE"], userID, request.args.get("start"),
+                                                 request.args.get("end"))
+    except ValueError:
+        return apology("Dates must be given as YYYY-MM-DD.")
 
-@app.route("/login", methods=["GET", "POST"])
+    return jsonify({"dates": [str(date) for date in dates],
+                    "values": [str(Money(value).dollars) for value in values.tolist()]})
+
+
+@bp.route("/leaderboard")
+@login_required
+@etag_cached(lambda: f"{session['user_id']}.{repo.report_computed('leaderboard')}")
+def leaderboard_page():
+    """Show every user's portfolio ranked by value, and the most widely held stocks"""
+
+    # "after" is the rank of the last user on the previous page
+    try:
+        after = max(int(request.args.get("after", 0)), 0)
+    except ValueError:
+        return apology("Invalid page.")
+
+    # Rankings are computed by a background job, so the page only reads its share of them
+    leaders = repo.leaderboard_page(LEADERBOARD_PAGE_SIZE + 1, after)
+    nextPage = None
+    if len(leaders) > LEADERBOARD_PAGE_SIZE:
+        leaders = leaders[:LEADERBOARD_PAGE_SIZE]
+        nextPage = leaders[-1]["rank"]
+
+    return render_template("leaderboard.html", leaders=leaders, nextPage=nextPage, firstPage=not after,
+                           own=repo.leaderboard_rank(session["user_id"]),
+                           symbols=repo.symbol_report_page(LEADERBOARD_SYMBOLS),
+                           computed=repo.report_computed("leaderboard"))
+
+
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
 
@@ -318,15 +699,31 @@ def login():
         elif not request.form.get("password"):
             return apology("must provide password", 403)
 
+        # Turn away repeated attempts from one address or at one account before hashing anything
+        wait = loginThrottle.attempt(("ip", request.remote_addr), ("user", request.form.get("username")))
+        if wait:
+            return too_many_requests("too many login attempts, try again later", wait)
+
         # Query database for username
-        rows = db.execute("SELECT * FROM users WHERE username = ?", request.form.get("username"))
+        user = repo.user_by_name(request.form.get("username"))
 
         # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(rows[0]["hash"], request.form.get("password")):
-            return apology("invalid username and/or password", 403)
+        try:
+            if user is None or not passwordHasher.check(user["hash"], request.form.get("password")):
+                return apology("invalid username and/or password", 403)
+        except passwords.Busy:
+            return too_many_requests("the server is busy, try again in a moment", 1)
+
+        # Bring the hash up to the current method now that the password is at hand
+        if passwordHasher.needs_rehash(user["hash"]):
+            try:
+                repo.set_password_hash(user["id"], passwordHasher.hash(request.form.get("password")))
+            except passwords.Busy:
+                # The next login will try again
+                pass
 
         # Remember which user has logged in
-        session["user_id"] = rows[0]["id"]
+        session["user_id"] = user["id"]
 
         # Redirect user to home page
         return redirect("/")
@@ -336,7 +733,7 @@ def login():
         return render_template("login.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     """Log user out"""
 
@@ -347,7 +744,7 @@ def logout():
     return redirect("/")
 
 
-@app.route("/quote", methods=["GET", "POST"])
+@bp.route("/quote", methods=["GET", "POST"])
 @login_required
 def quote():
     """Get stock quote."""
@@ -361,7 +758,6 @@ def quote():
 
         # Get information related to symbol
         dictLookup = lookup(symbol)
-        # print(dictLookup)
 
         # Show error page if the symbol doesn't exist
         if not dictLookup:
@@ -371,10 +767,7 @@ def quote():
 
         # Get the name of the company and stock price
         companyName = dictLookup["name"]
-        stockPrice = dictLookup["price"]
-
-        # Format the stock price as currency
-        stockPrice = locale.currency(stockPrice, grouping=True)
+        stockPrice = Money.from_dollars(dictLookup["price"])
 
         return render_template("quoted.html", name=companyName, symbol=symbol, price=stockPrice)
 
@@ -382,7 +775,7 @@ def quote():
         return render_template("quote.html")
 
 
-@app.route("/register", methods=["GET", "POST"])
+@bp.route("/register", methods=["GET", "POST"])
 def register():
     """Register user"""
 
@@ -393,15 +786,17 @@ def register():
         password = request.form.get("password")
         confirmation = request.form.get("confirmation")
 
-        # Search for the username in the users table
-        rows = db.execute("SELECT * FROM users WHERE username = ?", username)
-
         # Check if username has been input
         if username in ["", None]:
             return apology("No username has been entered.")
 
+        # Limit how many accounts one address can try to create
+        wait = loginThrottle.attempt(("ip", request.remote_addr))
+        if wait:
+            return too_many_requests("Too many attempts, try again later.", wait)
+
         # Check if username is not already in the database
-        if len(rows) != 0:
+        if repo.user_by_name(username) is not None:
             return apology("The username \"" + username + "\" is already in use.")
 
         # Check if password has been input
@@ -417,10 +812,13 @@ def register():
             return apology("The passwords do not match.")
 
         # Hash the user's password
-        hashedPassword = generate_password_hash(password)
+        try:
+            hashedPassword = passwordHasher.hash(password)
+        except passwords.Busy:
+            return too_many_requests("The server is busy, try again in a moment.", 1)
 
         # Insert the username and hashed password into the finance.db database
-        db.execute("INSERT INTO users(username, hash) VALUES(?, ?)", username, hashedPassword)
+        repo.add_user(username, hashedPassword)
 
         return render_template("login.html")
 
@@ -428,34 +826,38 @@ def register():
         return render_template("register.html")
 
 
-@app.route("/search", methods=["GET", "POST"])
+@bp.route("/search", methods=["GET", "POST"])
+@etag_cached(lambda: symbolDirectory.version,
+             # Until the symbol list has been downloaded, don't let caches hold on to empty suggestions
+             lambda: "public, max-age=300" if len(symbolDirectory) else None)
 def search():
     # Get the text after "search?q="
-    entry = request.args.get("q")
+    entry = request.args.get("q", "")
 
-    # Get API KEY
-    api_key = os.environ.get("API_KEY")
+    # Cap the number of suggestions sent back
+    try:
+        limit = min(int(request.args.get("limit", 10)), 50)
+    except ValueError:
+        limit = 10
 
-    # Get all of the stock symbols
-    url = f"https://cloud.iexapis.com/stable/ref-data/iex/symbols?token={api_key}"
-    symbols = requests.get(url)  # Type: <class: 'requests.models.Response'>
-    # print("\ntype of object: " + str(type(symbols)) + "\n")
-    symbols = symbols.json()  # New type: <class 'list'>
-    # print("type of object: " + str(type(symbols)) + "\n")
+    # Find the symbols starting with the text typed so far
+    matchedSymbols = symbolDirectory.search(entry, limit)
 
-    # Initialize list
-    matchedSymbols = []
+    return jsonify(matchedSymbols)
 
-    # Iterate through all the symbols and add the matching ones to a list
-    for symbolInfo in symbols:
-        if re.match(entry, symbolInfo["symbol"]) != None:
-            matchedSymbols.append(symbolInfo)
 
-    return jsonify(matchedSymbols)
+@bp.cli.command("refresh-symbols")
+def refresh_symbols():
+    """Download the latest list of stock symbols."""
+    if symbolDirectory.refresh():
+        print(f"{len(symbolDirectory)} symbols saved.")
+    else:
+        print("The symbol list could not be downloaded.")
 
 
-@app.route("/sell", methods=["GET", "POST"])
+@bp.route("/sell", methods=["GET", "POST"])
 @login_required
+@etag_cached(ledger_version)
 def sell():
     """Sell shares of stock"""
 
@@ -480,62 +882,32 @@ def sell():
         except ValueError:
             return apology("A valid integer amount of shares must be entered.")
 
-        # Find all the stock types the user has
-        stockTypesDict = db.execute("SELECT DISTINCT stock_symbol FROM transactions WHERE user_id=?", userID)
-
-        stockTypesList = []
-
-        # Create a list of the stock types owned by the user
-        for stockType in stockTypesDict:
-            stockTypesList.append(stockType["stock_symbol"])
+        # Find the user's position in the stock selected
+        totalStocksOfSelectedType = repo.shares_held(userID, symbol)
 
         # Double check if the user has a stock of the selected type
-        if symbol not in stockTypesList:
+        if not totalStocksOfSelectedType:
             return apology("The user does not own any \"" + symbol + "\" stocks.")
 
         # Check if the user has input a number greater than 1
         if amount < 1:
             return apology("The shares amount must be 1 or more.")
 
-        # Find the total amount of stocks the user owns of the type selected
-        totalStocksOfSelectedType = db.execute("SELECT SUM(shares_count) sum FROM transactions WHERE user_id=? \
-                                                AND stock_symbol=?", userID, symbol)[0]["sum"]
-
-        #print("User " + str(userID) + "'s total stocks of type " + symbol + ": " + str(totalStocksOfSelectedType))
-
         # Check if the user has enough stocks of the type selected
         if amount > totalStocksOfSelectedType:
             return apology("The user does not have enough stocks of type \"" + symbol + ".\"")
 
-        # Get the current time and format it
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # Look up the current cost of a share of the type selected
-        cost = lookup(symbol)["price"]
-
-        # Insert into the transactions table
-        # Make the amount negative as this is a sale
-        db.execute("INSERT INTO transactions(user_id, stock_symbol, cost, shares_count, time) VALUES(?, ?, ?, ?, ?)",
-                   userID, symbol, cost, (-1 * amount), now)
-
-        # Calculate the total cost/return of the stocks
-        totalCost = amount * cost
-
-        # Get the user's cash balance
-        cash = db.execute("SELECT cash FROM users WHERE id=?", userID)[0]["cash"]
-
-        # Calculate the user's remaining cash balance
-        updatedCash = cash + totalCost
-
-        # Account for errors in floating-point addition
-        updatedCash = (int(updatedCash * 100)) / 100
-
-        # print(f"\ncash: {cash}")
-        # print(f"total cost: {totalCost}")
-        # print(f"balance after sale: {updatedCash}\n")
+        # Look up the current cost of a share of the type selected; there's none while the quote API is unavailable
+        dictLookup = lookup(symbol)
+        if not dictLookup:
+            return apology("The stock price could not be retrieved.", 503)
+        cost = Money.from_dollars(dictLookup["price"])
 
-        # Update the cash balance in the users table
-        db.execute("UPDATE users SET cash=? WHERE id=?", updatedCash, userID)
+        # Sell the shares, checking the user still holds them in the same transaction
+        try:
+            trades.sell(db, userID, symbol, amount, cost)
+        except trades.TradeError as e:
+            return apology(str(e))
 
         # Flash the message to be passed to the index page
         flash(f"{amount} {symbol} share(s) sold!")
@@ -546,14 +918,154 @@ def sell():
         # Store the user's ID
         userID = session["user_id"]
 
-        # Find the types of stocks purchased by the user
-        # Keep the stock_symbol 'DEPOSIT' out of the query results
-        stockTypes = db.execute("SELECT DISTINCT stock_symbol FROM transactions WHERE user_id=? AND stock_symbol <> 'DEPOSIT'",
-                                userID)
+        # Find the types of stocks held by the user
+        stockTypes = repo.held_symbols(userID)
 
         return render_template("sell.html", stockTypes=stockTypes)
 
 
+@bp.route("/orders/batch", methods=["POST"])
+@login_required
+def batch_orders():
+    """Buy and sell several stocks at once from a JSON basket of orders"""
+
+    # Expect {"orders": [{"symbol": "AAPL", "side": "buy", "shares": 10}, ...]}
+    basket = request.get_json(silent=True)
+    requested = basket.get("orders") if isinstance(basket, dict) else None
+    if not isinstance(requested, list) or not requested:
+        return jsonify(error="A list of orders must be sent."), 400
+    if len(requested) > MAX_BATCH_ORDERS:
+        return jsonify(error=f"At most {MAX_BATCH_ORDERS} orders can be sent at once."), 400
+
+    # Check every order before pricing any of them
+    signedShares = {}
+    for order in requested:
+        if not isinstance(order, dict):
+            return jsonify(error="Each order must be an object."), 400
+        symbol = str(order.get("symbol") or "").upper()
+        side = order.get("side")
+        shares = order.get("shares")
+        if not symbol:
+            return jsonify(error="Each order needs a symbol."), 400
+        if side not in ["buy", "sell"]:
+            return jsonify(error=f"The side of the {symbol} order must be buy or sell."), 400
+        if not isinstance(shares, int) or isinstance(shares, bool) or shares < 1:
+            return jsonify(error=f"The shares amount of the {symbol} order must be 1 or more."), 400
+        if symbol in signedShares:
+            return jsonify(error=f"The symbol \"{symbol}\" appears in more than one order."), 400
+        signedShares[symbol] = shares if side == "buy" else -shares
+
+    # Price the whole basket with one quote request
+    quotes = lookup_many(list(signedShares))
+    unknown = [symbol for symbol in signedShares if not quotes.get(symbol)]
+    if unknown:
+        return jsonify(error="No quote for " + ", ".join(unknown) + "."), 400
+    priced = [(symbol, shares, Money.from_dollars(quotes[symbol]["price"])) for symbol, shares in signedShares.items()]
+
+    # Check cash and holdings and write every order in a single transaction
+    userID = session["user_id"]
+    try:
+        trades.batch(db, userID, priced)
+    except trades.TradeError as e:
+        return jsonify(error=str(e)), 400
+
+    cash = Money(repo.cash(userID))
+    return jsonify(orders=[{"symbol": symbol, "side": "buy" if shares > 0 else "sell", "shares": abs(shares),
+                            "price": json_dollars(price)} for symbol, shares, price in priced],
+                   cash=json_dollars(cash))
+
+
+@bp.cli.command("check-query-plans")
+def check_query_plans():
+    """Check that every route's queries are answered through an index."""
+    problems = migrations.check_query_plans(current_app.config["DATABASE"])
+    for name, plan in problems.items():
+        print(f"{name}: {'; '.join(plan)}")
+    if problems:
+        raise SystemExit(1)
+    print("Every route query uses an index.")
+
+
+@bp.cli.command("refresh-leaderboard")
+def refresh_leaderboard():
+    """Rank every user's portfolio and the most widely held stocks now."""
+    import leaderboard
+    count = leaderboard.refresh(current_app.config["DATABASE"], lookup_many)
+    print(f"{count} users ranked.")
+
+
+@bp.cli.command("import-prices")
+@click.argument("files", nargs=-1, required=True, type=click.File("r"))
+@click.option("--symbol", help="Symbol the prices belong to, if the files don't say.")
+def import_prices(files, symbol):
+    """Load daily closing prices from CSV files."""
+    import prices
+    for file in files:
+        count = prices.import_csv(current_app.config["DATABASE"], file, symbol)
+        print(f"{count} prices imported from {file.name}.")
+
+
+@bp.cli.command("import-statement")
+@click.argument("username")
+@click.argument("files", nargs=-1, required=True, type=click.File("r", encoding="utf-8-sig"))
+def import_statement(username, files):
+    """Add the trades and deposits in CSV or OFX statements to a user's history."""
+    user = repo.user_by_name(username)
+    if user is None:
+        raise click.BadParameter(f"there is no user {username!r}", param_hint="USERNAME")
+    for file in files:
+        try:
+            count = statements.import_statement(current_app.config["DATABASE"], user["id"], file, file.name,
+                                                symbolDirectory)
+        except statements.StatementError as e:
+            raise click.ClickException(f"{file.name}: {e}")
+        print(f"{count} transactions imported from {file.name}.")
+
+
+@bp.cli.group("holdings")
+def holdings_command():
+    """Maintain the holdings table."""
+
+
+@holdings_command.command("rebuild")
+@click.option("--user", "userID", type=int, help="Only rebuild this user's positions.")
+def rebuild_holdings(userID):
+    """Recompute holdings from the transactions ledger."""
+    count = holdings.rebuild(db, userID)
+    print(f"{count} positions rebuilt.")
+
+
+@holdings_command.command("verify")
+def verify_holdings():
+    """Check holdings and cash against the transactions ledger."""
+    mismatches = holdings.verify(db) + snapshots.verify_cash(db)
+    for mismatch in mismatches:
+        print(mismatch)
+    if mismatches:
+        raise SystemExit(1)
+    print("Holdings match the ledger.")
+
+
+@bp.cli.group("ledger")
+def ledger_command():
+    """Checkpoint and archive the transactions ledger."""
+
+
+@ledger_command.command("checkpoint")
+def checkpoint_ledger():
+    """Snapshot every user who has traded since their last snapshot."""
+    count = snapshots.checkpoint(db)
+    print(f"{count} users checkpointed.")
+
+
+@ledger_command.command("archive")
+@click.option("--before", required=True, help="Archive transactions dated before this day (YYYY-MM-DD).")
+def archive_ledger(before):
+    """Move old transactions into the compressed archive."""
+    count = snapshots.archive(db, before)
+    print(f"{count} transactions archived.")
+
+
 def errorhandler(e):
     """Handle error"""
     if not isinstance(e, HTTPException):
@@ -561,10 +1073,6 @@ def errorhandler(e):
     return apology(e.name, e.code)
 
 
-# Listen for errors
-for code in default_exceptions:
-    app.errorhandler(code)(errorhandler)
-
 # Code to launch the local server
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0', port=8080)
\ No newline at end of file
+    create_app().run(debug=True, host='0.0.0.0', port=8080)
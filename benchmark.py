@@ -0,0 +1,753 @@
+"""
+Benchmark every route against a synthetic database.
+
+Seeds a fresh SQLite database with users, trades and positions, serves
+quotes from the deterministic fake provider, then drives each route through
+Flask's test client, one request at a time and then from several threads at
+once. Latency percentiles, throughput and SQL statements per request are
+printed and saved as JSON so that runs can be compared:
+
+    python benchmark.py --users 10000 --transactions 10000000 --output after.json --compare before.json
+"""
+
+import argparse
+import csv
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+import migrations
+import orders
+from gateway import FakeProvider, _fake_symbol
+
+# Password given to every seeded user
+PASSWORD = "benchmark"
+
+# Symbols users trade, and how many of them each user picks from
+SYMBOL_COUNT = 500
+SYMBOLS_PER_USER = 20
+
+# Cash every seeded user starts with, in cents
+STARTING_CASH = 1000000
+
+# Highest price the fake provider quotes, in cents
+HIGHEST_PRICE = 100099
+
+# Ledger rows written per executemany() call while seeding
+SEED_CHUNK = 10000
+
+# Settings every mode creates the application with: no background jobs competing for the CPU, no login throttle
+# turning away the benchmark's many logins from one address, and prices polled often enough that a new stream's
+# first event isn't timed against the ticker's sleep
+APP_CONFIG = {"TESTING": True, "BACKGROUND_JOBS": False, "LOGIN_ATTEMPTS": 0, "PRICE_STREAM_INTERVAL": 0.01}
+
+# Routes that answer a successful request with a redirect to the portfolio rather than a 200
+REDIRECTING_ROUTES = {"POST /buy", "POST /sell", "POST /deposit"}
+
+
+def seed(path, users, transactions, seed=0):
+    """Create a database at path holding the given number of users and ledger rows."""
+    rng = random.Random(seed)
+    provider = FakeProvider(symbol_count=SYMBOL_COUNT)
+    symbols = [symbol for symbol, name in provider.symbols()]
+    prices = {symbol: round(provider.quote(symbol)["price"] * 100) for symbol in symbols}
+
+    # The migrations create the schema of a new database
+    migrations.migrate(path)
+
+    userSymbols = {userID: rng.sample(symbols, SYMBOLS_PER_USER) for userID in range(1, users + 1)}
+    positions = {}
+    cash = dict.fromkeys(userSymbols, STARTING_CASH)
+    start = datetime(2020, 1, 1)
+    step = timedelta(days=3 * 365) / max(transactions, 1)
+
+    def ledger():
+        """Yield trades in time order, keeping positions and cash up to date."""
+        for number in range(transactions):
+            userID = rng.randint(1, users)
+            symbol = rng.choice(userSymbols[userID])
+            price = max(1, prices[symbol] + rng.randint(-prices[symbol] // 10, prices[symbol] // 10))
+            position = positions.setdefault((userID, symbol), [0, 0, 0])
+
+            # Sell part of a position now and then, otherwise buy
+            if position[0] and rng.random() < 0.3:
+                shares = -rng.randint(1, position[0])
+                removed = position[1] * -shares // position[0]
+                position[1] -= removed
+                position[2] += -shares * price - removed
+            else:
+                shares = rng.randint(1, 20)
+                position[1] += shares * price
+            position[0] += shares
+            cash[userID] -= shares * price
+
+            yield userID, symbol, price, shares, (start + step * number).strftime("%Y-%m-%d %H:%M:%S")
+
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute("BEGIN")
+
+    rows = ledger()
+    while True:
+        chunk = [row for row, _ in zip(rows, range(SEED_CHUNK))]
+        if not chunk:
+            break
+        connection.executemany("INSERT INTO transactions (user_id, stock_symbol, cost, shares_count, time) "
+                               "VALUES(?, ?, ?, ?, ?)", chunk)
+
+    # Cover anyone who spent more than they started with by a deposit dated before their first trade
+    deposits = [(userID, "DEPOSIT", -balance, 0, "2019-12-31 00:00:00") for userID, balance in cash.items() if balance < 0]
+    connection.executemany("INSERT INTO transactions (user_id, stock_symbol, cost, shares_count, time) "
+                           "VALUES(?, ?, ?, ?, ?)", deposits)
+
+    passwordHash = generate_password_hash(PASSWORD)
+    connection.executemany("INSERT INTO users (id, username, hash, cash) VALUES(?, ?, ?, ?)",
+                           [(userID, f"user{userID}", passwordHash, max(balance, 0)) for userID, balance in cash.items()])
+    connection.executemany("INSERT INTO holdings (user_id, symbol, shares, cost_basis, realized) VALUES(?, ?, ?, ?, ?)",
+                           [(userID, symbol, *position) for (userID, symbol), position in positions.items()])
+    connection.executemany("INSERT INTO symbols (symbol, name, updated) VALUES(?, ?, ?)",
+                           [(symbol, name, datetime.now().strftime("%Y-%m-%d %H:%M:%S")) for symbol, name in provider.symbols()])
+    connection.execute("COMMIT")
+    connection.execute("ANALYZE")
+    connection.close()
+
+
+def create_app(path, **config):
+    """
+    Create the application over the database at path, with APP_CONFIG and
+    any config given, quotes from the fake provider and sessions kept in a
+    file beside the database.
+    """
+    # Quotes are read from the environment when first needed
+    os.environ["QUOTE_PROVIDER"] = "fake"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import application
+
+    return application.create_app(dict(APP_CONFIG, DATABASE=path,
+                                       SESSION_DATABASE=os.path.join(os.path.dirname(path), "sessions.db"), **config))
+
+
+class QueryCounter:
+    """Count the statements each thread runs through the database handles it wraps."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def wrap(self, handle):
+        """Return handle with every call to one of its public methods counted as a statement."""
+        return _Counted(handle, self)
+
+    def add(self):
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+    def take(self):
+        """Return the number of statements this thread ran since the last call."""
+        count = getattr(self._local, "count", 0)
+        self._local.count = 0
+        return count
+
+
+class _Counted:
+    """A database handle (the CS50 library's or the repository) whose public methods each run one statement."""
+
+    def __init__(self, handle, counter):
+        self._handle = handle
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._handle, name)
+        if name.startswith("_") or not callable(attribute):
+            return attribute
+
+        def counted(*args, **kwargs):
+            self._counter.add()
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def percentile(values, fraction):
+    """Return the value below which the given fraction of sorted values fall."""
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(latencies, elapsed, queries, errors):
+    """Turn raw timings into the figures saved for each route."""
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "queries_per_request": round(sum(queries) / len(queries), 2) if queries else 0,
+    }
+
+
+def routes(rng):
+    """Return, by route name, functions building (method, path, form data) for a request as a given user."""
+    symbols = [_fake_symbol(index) for index in range(SYMBOL_COUNT)]
+    return {
+        "GET /": lambda user: ("GET", "/", None),
+        "GET /history": lambda user: ("GET", "/history", None),
+        "GET /history?per_page=500": lambda user: ("GET", "/history?per_page=500", None),
+        "GET /history/export": lambda user: ("GET", "/history/export?format=csv", None),
+        "GET /sell": lambda user: ("GET", "/sell", None),
+        "GET /portfolio": lambda user: ("GET", "/portfolio", None),
+        "GET /search": lambda user: ("GET", "/search?q=" + rng.choice(symbols)[:1], None),
+        "POST /quote": lambda user: ("POST", "/quote", {"symbol": rng.choice(symbols)}),
+        "POST /buy": lambda user: ("POST", "/buy", {"symbol": rng.choice(symbols), "shares": "1"}),
+        "POST /sell": lambda user: ("POST", "/sell", {"symbol": user["symbol"], "shares": "1"}),
+        "POST /deposit": lambda user: ("POST", "/deposit", {"deposit amount": "1.00"}),
+        "GET /leaderboard": lambda user: ("GET", "/leaderboard?after=" + str(rng.randrange(1000)), None),
+        "GET /prices/stream": lambda user: ("GET", "/prices/stream", None),
+    }
+
+
+def drive(app, counter, users, build, count, concurrency, expected=200):
+    """
+    Send count requests built by build from concurrency threads, returning
+    the summary. Any response with another status than expected, or any
+    redirect to the login page, counts as an error.
+    """
+    latencies = []
+    queries = []
+    errors = []
+    lock = threading.Lock()
+
+    # Log every thread's client in before the clock starts
+    clients = []
+    for _ in range(concurrency):
+        user = random.choice(users)
+        client = app.test_client()
+        client.post("/login", data={"username": user["username"], "password": PASSWORD})
+        clients.append((user, client))
+
+    def worker(job):
+        (user, client), share = job
+        counter.take()
+        for _ in range(share):
+            method, path, data = build(user)
+            started = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            if response.mimetype == "text/event-stream":
+                # A stream never ends, so time its first event and hang up
+                next(response.iter_encoded(), b"")
+            else:
+                response.get_data()
+            response.close()
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                queries.append(counter.take())
+                if response.status_code != expected or response.location == "/login":
+                    errors.append(response.status_code)
+
+    shares = [count // concurrency + (1 if index < count % concurrency else 0) for index in range(concurrency)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, zip(clients, shares)))
+    return summarize(latencies, time.perf_counter() - started, queries, len(errors))
+
+
+def load_users(path, sample):
+    """Return up to sample users, with the symbol each holds most of, for the request threads to log in as."""
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute("SELECT users.id, username, (SELECT symbol FROM holdings WHERE user_id = users.id "
+                                  "ORDER BY shares DESC LIMIT 1) FROM users ORDER BY random() LIMIT ?", (sample,)).fetchall()
+    finally:
+        connection.close()
+    return [{"id": userID, "username": username, "symbol": symbol or "A"} for userID, username, symbol in rows]
+
+
+def fund(path, users, trades):
+    """
+    Give each of users enough cash to buy trades shares at the highest fake
+    price, and trades more shares of their symbol to sell, through a deposit
+    and a purchase in their ledger.
+    """
+    provider = FakeProvider(symbol_count=SYMBOL_COUNT)
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        for user in users:
+            price = round(provider.quote(user["symbol"])["price"] * 100)
+            deposit = trades * (price + HIGHEST_PRICE)
+            connection.executemany("INSERT INTO transactions (user_id, stock_symbol, cost, shares_count, time) "
+                                   "VALUES(?, ?, ?, ?, ?)", [(user["id"], "DEPOSIT", deposit, 0, now),
+                                                              (user["id"], user["symbol"], price, trades, now)])
+            connection.execute("UPDATE users SET cash = cash + ? WHERE id = ?", (deposit - trades * price, user["id"]))
+            connection.execute("INSERT INTO holdings (user_id, symbol, shares, cost_basis) VALUES(?, ?, ?, ?) "
+                               "ON CONFLICT (user_id, symbol) DO UPDATE SET shares = shares + excluded.shares, "
+                               "cost_basis = cost_basis + excluded.cost_basis",
+                               (user["id"], user["symbol"], trades, trades * price))
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+
+
+def query_overhead(app, users, count):
+    """Time the routes' most frequent queries through the CS50 library and through the repository."""
+    import application
+
+    # Inside a request, as the routes run them
+    with app.test_request_context():
+        db = application.get_db()
+        repo = application.get_repository()
+        cases = {
+            "cash": (lambda user: db.execute("SELECT cash FROM users WHERE id = ?", user["id"]),
+                     lambda user: repo.cash(user["id"])),
+            "login": (lambda user: db.execute("SELECT id, username, hash FROM users WHERE username = ?", user["username"]),
+                      lambda user: repo.user_by_name(user["username"])),
+            "positions": (lambda user: db.execute("SELECT symbol, shares, cost_basis, realized FROM holdings "
+                                                  "WHERE user_id = ? ORDER BY symbol", user["id"]),
+                          lambda user: repo.positions(user["id"])),
+            "history page": (lambda user: db.execute("SELECT transaction_no, stock_symbol, shares_count, cost, time "
+                                                     "FROM transactions WHERE user_id = ? "
+                                                     "ORDER BY time DESC, transaction_no DESC LIMIT ?", user["id"], 51),
+                             lambda user: repo.history_page(user["id"], 51)),
+        }
+
+        results = {}
+        for name, (cs50Query, repositoryQuery) in cases.items():
+            timings = {}
+            for label, query in [("cs50", cs50Query), ("repository", repositoryQuery)]:
+                # Warm the connection, statement cache and pages first
+                for user in users:
+                    query(user)
+                started = time.perf_counter()
+                for number in range(count):
+                    query(users[number % len(users)])
+                timings[label] = (time.perf_counter() - started) / count
+            results[name] = {"cs50_us": round(timings["cs50"] * 1e6, 1),
+                             "repository_us": round(timings["repository"] * 1e6, 1),
+                             "speedup": round(timings["cs50"] / timings["repository"], 1)}
+
+        # Return the CS50 library's connection to its pool, as a request would
+        db._disconnect()
+    return results
+
+
+def login_storm(path, users, seconds, concurrency):
+    """
+    Time the history page alone and then during a storm of logins from
+    concurrency threads, once with passwords hashed in the request threads
+    and once in the hashing pool.
+    """
+    import application
+
+    results = {}
+    for mode, config in [("inline", {"PASSWORD_HASH_WORKERS": 0}), ("pool", {})]:
+        app = create_app(path, **config)
+
+        # Readers are logged in, and the pool's processes started, before the clock starts
+        readers = []
+        for user in users[:concurrency]:
+            client = app.test_client()
+            client.post("/login", data={"username": user["username"], "password": PASSWORD})
+            readers.append(client)
+
+        results[mode] = {}
+        for phase, storming in [("quiet", False), ("storm", True)]:
+            readLatencies = []
+            loginLatencies = []
+            statuses = []
+            lock = threading.Lock()
+            stop = threading.Event()
+
+            def read(client):
+                while not stop.is_set():
+                    started = time.perf_counter()
+                    client.get("/history").close()
+                    with lock:
+                        readLatencies.append(time.perf_counter() - started)
+
+            def login(number):
+                client = app.test_client()
+                while not stop.is_set():
+                    user = users[number % len(users)]
+                    number += concurrency
+                    started = time.perf_counter()
+                    response = client.post("/login", data={"username": user["username"], "password": PASSWORD})
+                    response.close()
+                    with lock:
+                        loginLatencies.append(time.perf_counter() - started)
+                        statuses.append(response.status_code)
+
+            threads = [threading.Thread(target=read, args=(client,)) for client in readers]
+            if storming:
+                threads += [threading.Thread(target=login, args=(number,)) for number in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            time.sleep(seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+            readLatencies.sort()
+            loginLatencies.sort()
+            results[mode][phase] = {
+                "history_requests": len(readLatencies),
+                "history_p50_ms": round(percentile(readLatencies, 0.50) * 1000, 2),
+                "history_p99_ms": round(percentile(readLatencies, 0.99) * 1000, 2),
+                "logins_per_second": round(statuses.count(302) / seconds, 1),
+                "login_p99_ms": round(percentile(loginLatencies, 0.99) * 1000, 2),
+                "logins_rejected": statuses.count(429),
+            }
+
+        with app.app_context():
+            application.get_password_hasher().close()
+    return results
+
+
+def statement_import(count, randomSeed=0):
+    """Time importing a CSV statement of count trades for one user, and how much the process grew meanwhile."""
+    import resource
+
+    import statements
+
+    rng = random.Random(randomSeed)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "import.db")
+
+    # One user with the starting cash and an empty ledger
+    seed(path, 1, 0, randomSeed)
+
+    provider = FakeProvider(symbol_count=SYMBOL_COUNT)
+    symbols = [symbol for symbol, name in provider.symbols()]
+    prices = {symbol: round(provider.quote(symbol)["price"] * 100) for symbol in symbols}
+
+    # Deposits pay for the purchases before they're made, and sales only sell shares already bought
+    statement = os.path.join(directory, "statement.csv")
+    held = {}
+    cash = STARTING_CASH
+    with open(statement, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["date", "symbol", "action", "quantity", "price"])
+        start = datetime(2000, 1, 1)
+        for number in range(count):
+            when = (start + timedelta(seconds=number * 60)).strftime("%Y-%m-%d %H:%M:%S")
+            symbol = rng.choice(symbols)
+            shares = rng.randint(1, 5)
+            if number % 10 == 0 or shares * prices[symbol] > cash and not held.get(symbol):
+                cash += 1000000
+                writer.writerow([when, "", "deposit", "", "10000.00"])
+            elif held.get(symbol) and (rng.random() < 0.4 or shares * prices[symbol] > cash):
+                shares = rng.randint(1, held[symbol])
+                held[symbol] -= shares
+                cash += shares * prices[symbol]
+                writer.writerow([when, symbol, "sell", shares, f"{prices[symbol] / 100:.2f}"])
+            else:
+                held[symbol] = held.get(symbol, 0) + shares
+                cash -= shares * prices[symbol]
+                writer.writerow([when, symbol, "buy", shares, f"{prices[symbol] / 100:.2f}"])
+
+    def ledger_version():
+        connection = sqlite3.connect(path)
+        try:
+            return connection.execute("SELECT ledger_version FROM users WHERE id = 1").fetchone()[0]
+        finally:
+            connection.close()
+
+    # ru_maxrss is the process's peak, so only growth beyond what it already reached shows up
+    versionBefore = ledger_version()
+    peakBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    with open(statement, newline="") as file:
+        imported = statements.import_statement(path, 1, file, statement, set(symbols))
+    elapsed = time.perf_counter() - started
+    peakAfter = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        "rows": imported,
+        "bytes": os.path.getsize(statement),
+        "seconds": round(elapsed, 2),
+        "rows_per_second": round(imported / elapsed),
+        "peak_growth_mb": round((peakAfter - peakBefore) / 1024, 1),
+
+        # The import raises the user's ledger version once by the rows written, rather than once per row
+        "ledger_version_change": ledger_version() - versionBefore,
+    }
+
+
+def order_book(count, ticks, seed=0):
+    """Time how long the order matcher takes to check a tick of prices against count resting orders."""
+    rng = random.Random(seed)
+    provider = FakeProvider(symbol_count=SYMBOL_COUNT)
+    prices = {symbol: round(provider.quote(symbol)["price"] * 100) for symbol, name in provider.symbols()}
+    symbols = list(prices)
+
+    # Resting orders with trigger prices within 20% of the current price
+    book = orders.OrderBook()
+    for orderID in range(1, count + 1):
+        symbol = rng.choice(symbols)
+        book.add({"id": orderID, "user_id": 1, "symbol": symbol, "side": rng.choice(orders.SIDES),
+                  "kind": rng.choice(orders.KINDS), "shares": 1,
+                  "trigger_price": max(1, round(prices[symbol] * rng.uniform(0.8, 1.2)))})
+
+    # Move every price by up to 1% per tick, refilling the book as orders cross
+    timings = []
+    crossed = 0
+    nextID = count + 1
+    for _ in range(ticks):
+        for symbol in symbols:
+            prices[symbol] = max(1, round(prices[symbol] * rng.uniform(0.99, 1.01)))
+        started = time.perf_counter()
+        filled = [order for symbol in book.symbols() for order in book.crossing(symbol, prices[symbol])]
+        timings.append(time.perf_counter() - started)
+
+        crossed += len(filled)
+        for order in filled:
+            order = dict(order, id=nextID, trigger_price=max(1, round(prices[order["symbol"]] * rng.uniform(0.8, 1.2))))
+            book.add(order)
+            nextID += 1
+
+    timings.sort()
+    return {
+        "orders": count,
+        "ticks": ticks,
+        "crossed_per_tick": round(crossed / ticks, 1),
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(timings, 0.99) * 1000, 3),
+    }
+
+
+def render(count, repeats, seed=0):
+    """Time rendering a history page of count transactions, including formatting every price."""
+    from flask import render_template
+
+    rng = random.Random(seed)
+    app = create_app(os.path.join(tempfile.mkdtemp(), "render.db"))
+    transactions = [{"transaction_no": number, "stock_symbol": rng.choice(["AAPL", "MSFT", "DEPOSIT"]),
+                     "shares_count": rng.randint(-50, 50), "cost": rng.randint(1, 10 ** 8),
+                     "time": "2024-01-01 00:00:00"} for number in range(count)]
+
+    timings = []
+    with app.test_request_context("/history"):
+        for _ in range(repeats + 1):
+            started = time.perf_counter()
+            page = render_template("history.html", transactions=transactions, nextPage=None, firstPage=True,
+                                   perPage=count)
+            timings.append(time.perf_counter() - started)
+
+    # The first render compiles the template
+    timings = sorted(timings[1:])
+    return {
+        "rows": count,
+        "repeats": repeats,
+        "bytes": len(page),
+        "p50_ms": round(percentile(timings, 0.50) * 1000, 1),
+        "us_per_row": round(percentile(timings, 0.50) / count * 1e6, 3),
+    }
+
+
+# Run in a fresh interpreter for each startup measurement, printing the seconds each stage took
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import application
+imported = time.perf_counter()
+app = application.create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+app.test_client().get("/login")
+served = time.perf_counter()
+print(imported - started, created - imported, served - created)
+"""
+
+
+def startup(runs):
+    """Time importing the application, creating it and serving its first request, each in a new process."""
+    directory = tempfile.mkdtemp()
+    config = dict(APP_CONFIG, DATABASE=os.path.join(directory, "startup.db"),
+                  SESSION_DATABASE=os.path.join(directory, "sessions.db"))
+    environment = dict(os.environ, QUOTE_PROVIDER="fake")
+    command = [sys.executable, "-c", STARTUP_SCRIPT, json.dumps(config)]
+
+    # The first run creates the database, which later runs only open
+    subprocess.run(command, env=environment, cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+                   capture_output=True)
+
+    stages = {"import": [], "create_app": [], "first_request": []}
+    for _ in range(runs):
+        output = subprocess.run(command, env=environment, cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+                                capture_output=True, text=True).stdout
+        for stage, seconds in zip(stages, output.split()):
+            stages[stage].append(float(seconds))
+
+    results = {"runs": runs}
+    for stage, timings in stages.items():
+        timings.sort()
+        results[f"{stage}_p50_ms"] = round(percentile(timings, 0.50) * 1000, 1)
+    return results
+
+
+def compare(results, baseline):
+    """Print how each route's latency moved against an earlier run."""
+    for phase in ["sequential", "concurrent"]:
+        for name, current in results.get(phase, {}).items():
+            previous = baseline.get(phase, {}).get(name)
+            if not previous:
+                continue
+            for metric in ["p50_ms", "p95_ms", "p99_ms"]:
+                if previous[metric]:
+                    change = (current[metric] - previous[metric]) / previous[metric] * 100
+                    print(f"{phase:10} {name:28} {metric:7} {previous[metric]:9.3f} -> {current[metric]:9.3f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="users to seed (default 1000)")
+    parser.add_argument("--transactions", type=int, default=100000, help="ledger rows to seed (default 100000)")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route and phase (default 200)")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads in the concurrent phase (default 8)")
+    parser.add_argument("--routes", nargs="*", help="only measure these routes, such as 'GET /'")
+    parser.add_argument("--database", help="reuse a database seeded by an earlier run instead of seeding a new one")
+    parser.add_argument("--output", default="benchmark.json", help="file to save results to (default benchmark.json)")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic data")
+    parser.add_argument("--order-book", type=int, metavar="ORDERS",
+                        help="time the limit order matcher against this many resting orders instead of the routes")
+    parser.add_argument("--startup", type=int, metavar="RUNS",
+                        help="time importing and creating the app in this many new processes instead of the routes")
+    parser.add_argument("--render", type=int, metavar="ROWS",
+                        help="time rendering a history page of this many transactions instead of the routes")
+    parser.add_argument("--queries", type=int, metavar="COUNT",
+                        help="time COUNT runs of common queries through the CS50 library and the repository "
+                             "instead of the routes")
+    parser.add_argument("--import", type=int, metavar="ROWS", dest="import_rows",
+                        help="time importing a CSV statement of this many trades instead of the routes")
+    parser.add_argument("--login-storm", type=float, metavar="SECONDS",
+                        help="time the history page for SECONDS alone and SECONDS during a storm of logins, "
+                             "hashing passwords in the request threads and then in the pool, instead of the routes")
+    args = parser.parse_args()
+
+    if args.render:
+        results = render(args.render, min(args.requests, 20), args.seed)
+        print(f"{results['rows']} rows: p50 {results['p50_ms']:.1f}ms  {results['us_per_row']:.3f}us per row  "
+              f"({results['bytes']} bytes)")
+        with open(args.output, "w") as file:
+            json.dump({"render": results}, file, indent=2)
+        return
+
+    if args.startup:
+        results = startup(args.startup)
+        print(f"import {results['import_p50_ms']:.1f}ms  create_app {results['create_app_p50_ms']:.1f}ms  "
+              f"first request {results['first_request_p50_ms']:.1f}ms  (medians of {results['runs']} runs)")
+        with open(args.output, "w") as file:
+            json.dump({"startup": results}, file, indent=2)
+        return
+
+    if args.import_rows:
+        results = statement_import(args.import_rows, args.seed)
+        print(f"{results['rows']} rows ({results['bytes'] // 1024 // 1024} MB) imported in {results['seconds']:.2f}s  "
+              f"{results['rows_per_second']} rows/s  peak memory grew {results['peak_growth_mb']} MB  "
+              f"ledger version +{results['ledger_version_change']}")
+        with open(args.output, "w") as file:
+            json.dump({"import": results}, file, indent=2)
+        return
+
+    if args.order_book:
+        results = order_book(args.order_book, args.requests, args.seed)
+        print(f"{results['orders']} orders: p50 {results['p50_ms']:.3f}ms  p99 {results['p99_ms']:.3f}ms per tick  "
+              f"{results['crossed_per_tick']} crossed per tick")
+        with open(args.output, "w") as file:
+            json.dump({"order_book": results}, file, indent=2)
+        return
+
+    path = args.database
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+        started = time.perf_counter()
+        seed(path, args.users, args.transactions, args.seed)
+        print(f"Seeded {args.users} users and {args.transactions} transactions in {time.perf_counter() - started:.1f}s")
+
+    app = create_app(path)
+    import application
+
+    random.seed(args.seed)
+    rng = random.Random(args.seed)
+    users = load_users(path, max(args.concurrency, 16))
+
+    if args.queries:
+        results = query_overhead(app, users, args.queries)
+        for name, result in results.items():
+            print(f"{name:14} cs50 {result['cs50_us']:8.1f}us  repository {result['repository_us']:8.1f}us  "
+                  f"({result['speedup']:.1f}x)")
+        with open(args.output, "w") as file:
+            json.dump({"queries": results}, file, indent=2)
+        return
+
+    if args.login_storm:
+        results = login_storm(path, users, args.login_storm, args.concurrency)
+        for mode, phases in results.items():
+            for phase, result in phases.items():
+                print(f"{mode:6} {phase:5} history p50 {result['history_p50_ms']:8.2f}ms  "
+                      f"p99 {result['history_p99_ms']:8.2f}ms  {result['logins_per_second']:7.1f} logins/s  "
+                      f"login p99 {result['login_p99_ms']:8.2f}ms  {result['logins_rejected']} rejected")
+        with open(args.output, "w") as file:
+            json.dump({"login_storm": results}, file, indent=2)
+        return
+
+    # Each phase may send every purchase and sale as the same user
+    fund(path, users, 2 * args.requests)
+
+    # The leaderboard page reads the rankings its background job computes
+    import leaderboard
+    from helpers import lookup_many
+    started = time.perf_counter()
+    ranked = leaderboard.refresh(path, lookup_many)
+    print(f"Ranked {ranked} users in {time.perf_counter() - started:.2f}s")
+
+    # Count the statements each request runs through either database handle
+    counter = QueryCounter()
+    with app.app_context():
+        app.extensions["finance.db"] = counter.wrap(application.get_db())
+        app.extensions["finance.repository"] = counter.wrap(application.get_repository())
+    measured = {name: build for name, build in routes(rng).items() if not args.routes or name in args.routes}
+
+    results = {"config": {"users": args.users, "transactions": args.transactions, "requests": args.requests,
+                          "concurrency": args.concurrency, "seed": args.seed},
+               "sequential": {}, "concurrent": {}}
+    for phase, concurrency in [("sequential", 1), ("concurrent", args.concurrency)]:
+        for name, build in measured.items():
+            summary = drive(app, counter, users, build, args.requests, concurrency,
+                            302 if name in REDIRECTING_ROUTES else 200)
+            results[phase][name] = summary
+            print(f"{phase:10} {name:28} p50 {summary['p50_ms']:8.2f}ms  p95 {summary['p95_ms']:8.2f}ms  "
+                  f"p99 {summary['p99_ms']:8.2f}ms  {summary['throughput_rps']:8.1f} req/s  "
+                  f"{summary['queries_per_request']:5.1f} queries  {summary['errors']} errors")
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+    # Timings of failed requests aren't timings of the route, so make a run with any fail
+    failed = [f"{phase} {name}" for phase in ["sequential", "concurrent"]
+              for name, summary in results[phase].items() if summary["errors"]]
+    if failed:
+        sys.exit("Requests failed in: " + ", ".join(failed))
+
+
+if __name__ == "__main__":
+    main()
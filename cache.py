@@ -0,0 +1,229 @@
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MemoryBackend:
+    """Keep quotes in this process, evicting the least recently used."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, symbol):
+        """Return (quote, stored_at) for symbol, or None."""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is not None:
+                self._entries.move_to_end(symbol)
+            return entry
+
+    def set(self, symbol, quote, stored_at):
+        """Store a quote, dropping the oldest entries past maxsize."""
+        with self._lock:
+            self._entries[symbol] = (quote, stored_at)
+            self._entries.move_to_end(symbol)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class SQLiteBackend:
+    """
+    Share quotes between worker processes through a SQLite file.
+
+    Eviction only needs a rough order of use, so a hit records its time at
+    most once every touch_interval seconds per entry rather than taking the
+    file's write lock on every read.
+    """
+
+    def __init__(self, path, maxsize=1024, touch_interval=15):
+        self.path = path
+        self.maxsize = maxsize
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+
+        # Create the table up front so every worker sees the same schema
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS quote_cache (symbol TEXT PRIMARY KEY, name TEXT NOT NULL, \
+                           quote_symbol TEXT NOT NULL, price REAL NOT NULL, stored_at REAL NOT NULL, used_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS quote_cache_used_at ON quote_cache (used_at)")
+
+    def _connection(self):
+        """Return this thread's connection to the cache file."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode; WAL lets readers carry on while another worker writes
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, symbol):
+        """Return (quote, stored_at) for symbol, or None."""
+        connection = self._connection()
+        row = connection.execute("SELECT name, quote_symbol, price, stored_at, used_at FROM quote_cache WHERE symbol=?",
+                                 (symbol,)).fetchone()
+        if row is None:
+            return None
+        name, quoteSymbol, price, storedAt, usedAt = row
+
+        # Mark the entry as recently used for eviction purposes, unless that was done lately
+        now = time.time()
+        if now - usedAt >= self.touch_interval:
+            connection.execute("UPDATE quote_cache SET used_at=? WHERE symbol=?", (now, symbol))
+
+        return {"name": name, "price": price, "symbol": quoteSymbol}, storedAt
+
+    def set(self, symbol, quote, stored_at):
+        """Store a quote, dropping the oldest entries past maxsize."""
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO quote_cache (symbol, name, quote_symbol, price, stored_at, used_at) \
+                           VALUES (?, ?, ?, ?, ?, ?)",
+                           (symbol, quote["name"], quote["symbol"], quote["price"], stored_at, stored_at))
+        connection.execute("DELETE FROM quote_cache WHERE symbol IN \
+                           (SELECT symbol FROM quote_cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (self.maxsize,))
+
+
+class _Flight:
+    """A network fetch that other requests for the same symbol can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.quote = None
+
+
+class QuoteCache:
+    """
+    Cache quotes for ttl seconds in front of a fetch function.
+
+    Entries older than ttl but younger than ttl + stale_ttl are still served
+    while a single background refresh for that symbol runs. Concurrent misses
+    for the same symbol share one fetch instead of each calling the API.
+    """
+
+    def __init__(self, fetch, fetch_many=None, ttl=60, stale_ttl=300, backend=None, refresh_workers=4, wait_timeout=10):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.wait_timeout = wait_timeout
+        self._fetch = fetch
+        self._fetch_many = fetch_many or (lambda symbols: {symbol: fetch(symbol) for symbol in symbols})
+        self._backend = backend if backend is not None else MemoryBackend()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._refreshing = set()
+        self._refresher = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix="quote-refresh")
+        self._counters = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "refreshes": 0, "errors": 0}
+
+    def get(self, symbol):
+        """Return the quote for one symbol, or None if it can't be found."""
+        return self.get_many([symbol])[symbol]
+
+    def get_many(self, symbols):
+        """Return a dict of quotes keyed by symbol, fetching only what's missing."""
+        now = time.time()
+        quotes = {}
+        missing = []
+
+        for symbol in symbols:
+            entry = self._backend.get(symbol)
+            age = now - entry[1] if entry is not None else None
+
+            # Fresh entry
+            if age is not None and age < self.ttl:
+                self._count("hits")
+                quotes[symbol] = entry[0]
+
+            # Stale entry: serve it, refresh behind the scenes
+            elif age is not None and age < self.ttl + self.stale_ttl:
+                self._count("stale_hits")
+                quotes[symbol] = entry[0]
+                self._refresh(symbol)
+
+            else:
+                self._count("misses")
+                missing.append(symbol)
+
+        if missing:
+            quotes.update(self._load(missing))
+
+        return quotes
+
+    def stats(self):
+        """Return a copy of the hit/miss/refresh counters."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["in_flight"] = len(self._flights)
+        return stats
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def _load(self, symbols):
+        """Fetch symbols, joining any fetch for them that's already running."""
+        leading = []
+        waiting = {}
+
+        # Claim the symbols nobody else is fetching yet
+        with self._lock:
+            for symbol in symbols:
+                flight = self._flights.get(symbol)
+                if flight is None:
+                    self._flights[symbol] = _Flight()
+                    leading.append(symbol)
+                else:
+                    waiting[symbol] = flight
+                    self._counters["coalesced"] += 1
+
+        quotes = {}
+        if leading:
+            try:
+                quotes = self._store(leading, self._fetch_many(leading))
+            finally:
+                # Hand the results to anyone waiting on these symbols
+                with self._lock:
+                    for symbol in leading:
+                        flight = self._flights.pop(symbol)
+                        flight.quote = quotes.get(symbol)
+                        flight.done.set()
+
+        for symbol, flight in waiting.items():
+            flight.done.wait(self.wait_timeout)
+            quotes[symbol] = flight.quote
+
+        return {symbol: quotes.get(symbol) for symbol in symbols}
+
+    def _store(self, symbols, fetched):
+        """Save successfully fetched quotes and return them."""
+        now = time.time()
+        quotes = {}
+        for symbol in symbols:
+            quote = fetched.get(symbol)
+            if quote is None:
+                self._count("errors")
+            else:
+                self._backend.set(symbol, quote, now)
+            quotes[symbol] = quote
+        return quotes
+
+    def _refresh(self, symbol):
+        """Start a background refresh for symbol unless one is already running."""
+        with self._lock:
+            if symbol in self._refreshing:
+                return
+            self._refreshing.add(symbol)
+            self._counters["refreshes"] += 1
+
+        def refresh():
+            try:
+                self._load([symbol])
+            finally:
+                with self._lock:
+                    self._refreshing.discard(symbol)
+
+        self._refresher.submit(refresh)
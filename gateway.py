@@ -0,0 +1,300 @@
+import threading
+import time
+import urllib.parse
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from cache import MemoryBackend
+
+# Most symbols the IEX batch endpoint accepts in a single request
+BATCH_SIZE = 100
+
+
+class ProviderError(Exception):
+    """The quote provider couldn't be reached or answered with an error."""
+
+
+class IEXProvider:
+    """Quotes from the IEX Cloud API over a pooled keep-alive session."""
+
+    def __init__(self, api_key, base_url="https://cloud.iexapis.com/stable", timeout=(3.05, 5), pool_size=8):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        # Reuse connections and retry idempotent GETs once on flaky gateways
+        self.session = requests.Session()
+        retry = Retry(total=1, backoff_factor=0.2, status_forcelist=[502, 503, 504], allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _get(self, path, **params):
+        """GET a path of the API, returning the response or None for a 404."""
+        params["token"] = self.api_key
+        try:
+            response = self.session.get(f"{self.base_url}/{path}", params=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ProviderError(str(e)) from e
+
+        # An unknown symbol isn't a provider failure
+        if response.status_code == 404:
+            return None
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as e:
+            raise ProviderError(str(e)) from e
+        return response
+
+    def quote(self, symbol):
+        """Return the quote for symbol, or None if the API doesn't know it."""
+        response = self._get(f"stock/{urllib.parse.quote_plus(symbol)}/quote")
+        if response is None:
+            return None
+        try:
+            return _parse_quote(response.json())
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def quotes(self, symbols):
+        """Return quotes for several symbols, keyed by symbol, with one request per BATCH_SIZE symbols."""
+        quotes = {}
+        for start in range(0, len(symbols), BATCH_SIZE):
+            response = self._get("stock/market/batch", symbols=",".join(symbols[start:start + BATCH_SIZE]), types="quote")
+            if response is None:
+                continue
+            try:
+                # The response maps each symbol to {"quote": {...}}
+                for symbol, data in response.json().items():
+                    quotes[symbol.upper()] = _parse_quote(data["quote"])
+            except (KeyError, TypeError, ValueError) as e:
+                raise ProviderError(f"unexpected batch response: {e}") from e
+        return {symbol: quotes.get(symbol) for symbol in symbols}
+
+    def symbols(self):
+        """Return every symbol the API can quote as (symbol, name) pairs."""
+        response = self._get("ref-data/iex/symbols")
+        try:
+            return [(entry["symbol"].upper(), entry.get("name") or "") for entry in response.json()]
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ProviderError(f"unexpected symbols response: {e}") from e
+
+
+class FakeProvider:
+    """
+    Deterministic quotes with no network, for development, tests and benchmarks.
+
+    Prices come from the prices dict when given, otherwise from a checksum of
+    the symbol, so every run sees the same numbers. Any symbol of one to five
+    letters can be quoted; symbols() lists the first symbol_count of them.
+    latency adds a delay to every call and failing makes every call raise
+    ProviderError.
+    """
+
+    def __init__(self, prices=None, symbol_count=2000, latency=0, failing=False):
+        self.prices = dict(prices or {})
+        self.latency = latency
+        self.failing = failing
+        self.calls = 0
+
+        # Symbols A, B, ..., Z, AA, AB, ... up to symbol_count
+        self._symbols = sorted(set(self.prices) | {_fake_symbol(index) for index in range(symbol_count)})
+
+    def _call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failing:
+            raise ProviderError("fake provider is failing")
+
+    def _quote(self, symbol):
+        if symbol in self.prices:
+            price = self.prices[symbol]
+        elif symbol.isalpha() and len(symbol) <= 5:
+            price = 1 + zlib.crc32(symbol.encode()) % 100000 / 100
+        else:
+            return None
+        return {"name": f"{symbol} Corporation", "price": price, "symbol": symbol}
+
+    def quote(self, symbol):
+        self._call()
+        return self._quote(symbol)
+
+    def quotes(self, symbols):
+        self._call()
+        return {symbol: self._quote(symbol) for symbol in symbols}
+
+    def symbols(self):
+        self._call()
+        return [(symbol, f"{symbol} Corporation") for symbol in self._symbols]
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing provider for a while.
+
+    After failure_threshold failures in a row the breaker opens and calls are
+    refused for reset_timeout seconds. Then one trial call is let through:
+    success closes the breaker again, failure reopens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        """Tell whether a call may go ahead now."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            # Let a single trial call through once the timeout has passed
+            if not self._trial and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+class QuoteGateway:
+    """
+    The one way the app reaches a quote provider.
+
+    Calls are limited to max_concurrency at a time; a request that can't get a
+    slot within wait_timeout seconds is shed. Provider failures trip the
+    circuit breaker, and while it is open (or a call fails) the last price
+    seen for each symbol is returned instead, for the last_known symbols most
+    recently quoted.
+    """
+
+    def __init__(self, provider, max_concurrency=8, wait_timeout=2, breaker=None, last_known=4096):
+        self.provider = provider
+        self.wait_timeout = wait_timeout
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._fallback_pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="quote-fallback")
+        self._last = MemoryBackend(maxsize=last_known)
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "failures": 0, "fallbacks": 0, "shed": 0}
+
+    def quote(self, symbol):
+        """Return the quote for symbol, the last one seen if the provider is failing, or None."""
+        result = self._call(self.provider.quote, symbol)
+        if result is _FAILED:
+            return self._fallback([symbol])[symbol]
+        return self._remember({symbol: result})[symbol]
+
+    def quotes(self, symbols):
+        """Return quotes for several symbols, keyed by symbol."""
+        if not symbols:
+            return {}
+        result = self._call(self.provider.quotes, symbols)
+        if result is not _FAILED:
+            return self._remember(result)
+
+        # The batch failed; try symbols one at a time unless that opened the breaker
+        if self.breaker.state == "closed":
+            return dict(zip(symbols, self._fallback_pool.map(self.quote, symbols)))
+        return self._fallback(symbols)
+
+    def symbols(self):
+        """Return every symbol the provider can quote, or None if it is failing."""
+        result = self._call(self.provider.symbols)
+        return None if result is _FAILED else result
+
+    def stats(self):
+        """Return call/failure/fallback counters and the breaker's state."""
+        with self._lock:
+            stats = dict(self._counters)
+        stats["breaker"] = self.breaker.state
+        return stats
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _call(self, method, *args):
+        """Call the provider within the concurrency limit and the breaker's say-so."""
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            self._count("shed")
+            return _FAILED
+        try:
+            if not self.breaker.allow():
+                return _FAILED
+            self._count("calls")
+            result = method(*args)
+        except ProviderError:
+            self._count("failures")
+            self.breaker.record_failure()
+            return _FAILED
+        finally:
+            self._slots.release()
+        self.breaker.record_success()
+        return result
+
+    def _remember(self, quotes):
+        """Keep the latest good quotes to fall back on."""
+        now = time.time()
+        for symbol, quote in quotes.items():
+            if quote is not None:
+                self._last.set(symbol, quote, now)
+        return quotes
+
+    def _fallback(self, symbols):
+        """Return the last quote seen for each symbol, or None."""
+        self._count("fallbacks")
+        entries = {symbol: self._last.get(symbol) for symbol in symbols}
+        return {symbol: entry[0] if entry else None for symbol, entry in entries.items()}
+
+
+# Marks a provider call that failed, as opposed to one that found nothing
+_FAILED = object()
+
+
+def _parse_quote(quote):
+    """Pick the fields the app uses out of an IEX quote."""
+    return {
+        "name": quote["companyName"],
+        "price": float(quote["latestPrice"]),
+        "symbol": quote["symbol"]
+    }
+
+
+def _fake_symbol(index):
+    """Return the index-th symbol in the sequence A, B, ..., Z, AA, AB, ..."""
+    symbol = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        symbol = chr(ord("A") + remainder) + symbol
+    return symbol
@@ -1,9 +1,14 @@
+import logging
 import os
-import requests
-import urllib.parse
+import threading
+import time
+import zlib
 
-from flask import redirect, render_template, request, session
-from functools import wraps
+from cache import MemoryBackend, QuoteCache, SQLiteBackend
+from flask import current_app, make_response, redirect, render_template, request, session, url_for
+from functools import lru_cache, wraps
+from metrics import metrics, timed
+from money import Money, format_cents
 
 
 def apology(message, code=400):
@@ -35,28 +40,106 @@ def login_required(f):
     return decorated_function
 
 
+def etag_cached(version, cache_control="private, no-cache"):
+    """
+    Decorate GET routes so that browsers can revalidate their copy.
+
+    version() returns a string that changes whenever the page would, such as
+    the user's ledger version. Together with the route, the query string and
+    the templates' modification times it makes the response's ETag; a request whose If-None-Match already has that
+    tag gets 304 Not Modified without the route running. cache_control may
+    also be a function, called per response; if it returns None the
+    response isn't cached.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            # Pages showing a flashed message have to be rendered to show it
+            if request.method != "GET" or session.get("_flashes"):
+                return f(*args, **kwargs)
+
+            # Check the templates every time while they reload in development
+            templates = os.path.join(current_app.root_path, current_app.template_folder)
+            if current_app.debug:
+                stamp = _templates_version.__wrapped__(templates)
+            else:
+                stamp = _templates_version(templates)
+            etag = f"{request.endpoint}-{stamp}-{version()}-{zlib.crc32(request.query_string):x}"
+            if etag in request.if_none_match:
+                response = make_response("", 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            policy = cache_control() if callable(cache_control) else cache_control
+            if policy is not None:
+                response.headers["Cache-Control"] = policy
+            return response
+        return decorated_function
+    return decorator
+
+
+@lru_cache(maxsize=None)
+def _static_version(path):
+    return f"{int(os.path.getmtime(path)):x}"
+
+
+@lru_cache(maxsize=None)
+def _templates_version(folder):
+    """Return the latest modification time of the templates, so cached pages change when they do."""
+    return f"{int(max(os.path.getmtime(os.path.join(folder, name)) for name in os.listdir(folder))):x}"
+
+
+def static_url(filename):
+    """Return the URL of a static file, versioned by its modification time so it can be cached for long."""
+    url = url_for("static", filename=filename)
+    path = os.path.join(current_app.static_folder, filename)
+
+    # Check the file every time while templates reload in development
+    if current_app.debug:
+        return f"{url}?v={int(os.path.getmtime(path)):x}"
+    return f"{url}?v={_static_version(path)}"
+
+
+@timed("quote")
 def lookup(symbol):
     """Look up quote for symbol."""
+    return quote_cache().get(symbol.upper())
+
+
+@timed("quote")
+def lookup_many(symbols):
+    """Look up quotes for several symbols at once, keyed by symbol."""
+
+    # Drop duplicates while keeping the caller's order
+    symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+
+    if not symbols:
+        return {}
+
+    return quote_cache().get_many(symbols)
+
+
+def fetch_symbols():
+    """Fetch every symbol the API can quote as (symbol, name) pairs, or None."""
+    return quote_gateway().symbols()
 
-    # Contact API
-    try:
-        api_key = os.environ.get("API_KEY")
-        url = f"https://cloud.iexapis.com/stable/stock/{urllib.parse.quote_plus(symbol)}/quote?token={api_key}"
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.RequestException:
-        return None
-
-    # Parse response
-    try:
-        quote = response.json()
-        return {
-            "name": quote["companyName"],
-            "price": float(quote["latestPrice"]),
-            "symbol": quote["symbol"]
-        }
-    except (KeyError, TypeError, ValueError):
-        return None
+
+def every(seconds, func, name=None):
+    """Call func now and then every so many seconds on a daemon thread."""
+    def run():
+        while True:
+            try:
+                func()
+            except Exception:
+                logging.getLogger(__name__).exception("%s failed", name or func.__name__)
+            time.sleep(seconds)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
 
 
 """
@@ -110,6 +193,76 @@ def generateFullList():
 """
 
 
+def _quote_provider():
+    """Pick the quote provider named by QUOTE_PROVIDER."""
+    # The gateway imports requests, which is slow to load, so it waits until the first quote
+    from gateway import FakeProvider, IEXProvider
+
+    if os.environ.get("QUOTE_PROVIDER", "iex") == "fake":
+        return FakeProvider()
+    return IEXProvider(os.environ.get("API_KEY"), os.environ.get("IEX_BASE_URL", "https://cloud.iexapis.com/stable"),
+                       timeout=(3.05, float(os.environ.get("QUOTE_TIMEOUT", 5))))
+
+
+def _quote_cache_backend(ttl):
+    """Pick the quote cache backend named by QUOTE_CACHE_BACKEND."""
+    maxsize = int(os.environ.get("QUOTE_CACHE_SIZE", 1024))
+    if os.environ.get("QUOTE_CACHE_BACKEND", "memory") == "sqlite":
+        # Record a hit on an entry at most four times per ttl
+        return SQLiteBackend(os.environ.get("QUOTE_CACHE_PATH", "quote_cache.db"), maxsize, touch_interval=ttl / 4)
+    return MemoryBackend(maxsize)
+
+
+_quote_clients = None
+_quote_clients_lock = threading.Lock()
+
+
+def _quotes():
+    """Create the process-wide quote gateway and cache on first use, returning both."""
+    global _quote_clients
+    if _quote_clients is None:
+        with _quote_clients_lock:
+            if _quote_clients is None:
+                from gateway import QuoteGateway
+
+                # Every call to the quote provider goes through this gateway
+                gateway = QuoteGateway(_quote_provider(), max_concurrency=int(os.environ.get("QUOTE_CONCURRENCY", 8)))
+
+                # Process-wide quote cache shared by every route
+                ttl = float(os.environ.get("QUOTE_CACHE_TTL", 60))
+                cache = QuoteCache(gateway.quote, gateway.quotes, ttl=ttl,
+                                   stale_ttl=float(os.environ.get("QUOTE_CACHE_STALE_TTL", 300)),
+                                   backend=_quote_cache_backend(ttl))
+
+                # Report the cache's and the gateway's counters along with the request metrics
+                metrics.collect("quote_cache", cache.stats, gauges=["in_flight"])
+                metrics.collect("quote_gateway", gateway.stats)
+
+                _quote_clients = gateway, cache
+    return _quote_clients
+
+
+def quote_gateway():
+    """Return the gateway every call to the quote provider goes through."""
+    return _quotes()[0]
+
+
+def quote_cache():
+    """Return the quote cache shared by every route."""
+    return _quotes()[1]
+
+
 def usd(value):
-    """Format value as USD."""
+    """Format value as USD, leaving None blank."""
+    if value is None:
+        return ""
+    if isinstance(value, Money):
+        return format_cents(value.cents)
     return f"${value:,.2f}"
+
+
+def cents(value):
+    """Format a whole number of cents, as stored in the database, as USD, leaving None blank."""
+    if value is None:
+        return ""
+    return format_cents(value)
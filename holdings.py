@@ -0,0 +1,120 @@
+from money import Money
+
+
+def add_shares(db, user_id, symbol, shares, price):
+    """Record a purchase of shares at price (Money) in the user's position for symbol."""
+    db.execute("INSERT INTO holdings (user_id, symbol, shares, cost_basis) VALUES(?, ?, ?, ?) \
+               ON CONFLICT(user_id, symbol) DO UPDATE SET shares = shares + excluded.shares, \
+               cost_basis = cost_basis + excluded.cost_basis",
+               user_id, symbol, shares, (price * shares).cents)
+
+
+def add_many(db, user_id, purchases):
+    """Record several purchases, as (symbol, shares, price) with distinct symbols, in one statement."""
+    if not purchases:
+        return
+    values = ", ".join(["(?, ?, ?, ?)"] * len(purchases))
+    parameters = [value for symbol, shares, price in purchases for value in (user_id, symbol, shares, (price * shares).cents)]
+    db.execute(f"INSERT INTO holdings (user_id, symbol, shares, cost_basis) VALUES {values} \
+               ON CONFLICT(user_id, symbol) DO UPDATE SET shares = shares + excluded.shares, \
+               cost_basis = cost_basis + excluded.cost_basis", *parameters)
+
+
+def remove_shares(db, user_id, symbol, shares, price):
+    """
+    Record a sale of shares at price (Money) in the user's position for symbol.
+
+    The cost basis shrinks in proportion to the shares sold (average cost),
+    rounding the cents removed down, and the difference between the proceeds
+    and the cost removed is added to the position's realized gain. A position
+    sold off entirely is kept, with no shares, for its realized gain.
+    Returns False if the user doesn't hold that many shares.
+    """
+    updated = db.execute("UPDATE holdings SET realized = realized + ? - cost_basis * ? / shares, \
+                         cost_basis = cost_basis - cost_basis * ? / shares, shares = shares - ? \
+                         WHERE user_id=? AND symbol=? AND shares >= ?",
+                         (price * shares).cents, shares, shares, shares, user_id, symbol, shares)
+    return updated == 1
+
+
+def replay(transactions, positions=None):
+    """
+    Work out each position from ledger rows, returning
+    {(user_id, symbol): [shares, cost_basis, realized gain]} in cents.
+    The rows are applied on top of positions, if given, such as a snapshot's.
+    """
+    positions = {} if positions is None else positions
+    for transaction in transactions:
+        if transaction["stock_symbol"] == "DEPOSIT":
+            continue
+
+        key = (transaction["user_id"], transaction["stock_symbol"])
+        position = positions.setdefault(key, [0, 0, 0])
+        shares = transaction["shares_count"]
+
+        # Purchases add their cost, sales remove the average cost of the shares sold
+        if shares > 0:
+            position[1] += shares * transaction["cost"]
+        elif position[0]:
+            # Same integer arithmetic as remove_shares()
+            removed = position[1] * -shares // position[0]
+            position[1] -= removed
+            position[2] += -shares * transaction["cost"] - removed
+        position[0] += shares
+
+    return positions
+
+
+def _replay_ledger(db, user_id=None):
+    """Replay positions from each user's latest snapshot and the transactions since, for one user or everyone."""
+    if user_id is None:
+        snapshot = db.execute("SELECT user_id, symbol, shares, cost_basis, realized FROM snapshot_positions")
+        tail = db.execute("SELECT user_id, stock_symbol, shares_count, cost FROM transactions \
+                          WHERE transaction_no > COALESCE((SELECT transaction_no FROM snapshots \
+                          WHERE snapshots.user_id = transactions.user_id), 0) ORDER BY transaction_no")
+    else:
+        snapshot = db.execute("SELECT user_id, symbol, shares, cost_basis, realized FROM snapshot_positions \
+                              WHERE user_id=?", user_id)
+        tail = db.execute("SELECT user_id, stock_symbol, shares_count, cost FROM transactions WHERE user_id=? \
+                          AND transaction_no > COALESCE((SELECT transaction_no FROM snapshots WHERE user_id=?), 0) \
+                          ORDER BY transaction_no", user_id, user_id)
+    positions = {(row["user_id"], row["symbol"]): [row["shares"], row["cost_basis"], row["realized"]] for row in snapshot}
+    return replay(tail, positions)
+
+
+def rebuild(db, user_id=None):
+    """Recompute holdings from the ledger (from the latest snapshots on) for one user or everyone."""
+    positions = _replay_ledger(db, user_id)
+
+    db.execute("BEGIN TRANSACTION")
+    try:
+        if user_id is None:
+            db.execute("DELETE FROM holdings")
+        else:
+            db.execute("DELETE FROM holdings WHERE user_id=?", user_id)
+        for (userID, symbol), (shares, costBasis, realized) in positions.items():
+            db.execute("INSERT INTO holdings (user_id, symbol, shares, cost_basis, realized) VALUES(?, ?, ?, ?, ?)",
+                       userID, symbol, shares, costBasis, realized)
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+
+    return len(positions)
+
+
+def verify(db):
+    """Compare holdings with the ledger (from the latest snapshots on), returning a list of mismatch descriptions."""
+    expected = _replay_ledger(db)
+    actual = {(row["user_id"], row["symbol"]): [row["shares"], row["cost_basis"], row["realized"]]
+              for row in db.execute("SELECT user_id, symbol, shares, cost_basis, realized FROM holdings")}
+
+    mismatches = []
+    for key in sorted(expected.keys() | actual.keys()):
+        shares, costBasis, realized = expected.get(key, [0, 0, 0])
+        heldShares, heldCostBasis, heldRealized = actual.get(key, [0, 0, 0])
+        if shares != heldShares or costBasis != heldCostBasis or realized != heldRealized:
+            mismatches.append(f"user {key[0]} {key[1]}: ledger has {shares} shares costing {Money(costBasis)} "
+                              f"with {Money(realized)} realized, holdings has {heldShares} shares costing "
+                              f"{Money(heldCostBasis)} with {Money(heldRealized)} realized")
+    return mismatches
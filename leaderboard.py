@@ -0,0 +1,150 @@
+import sqlite3
+import time
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from money import Money
+
+# Rows written per executemany() call while saving the rankings
+WRITE_CHUNK = 5000
+
+# Seconds a worker may spend refreshing the rankings before another may take the run over
+LEASE_SECONDS = 15 * 60
+
+
+def refresh(path, fetch_many):
+    """
+    Rank every user by the value of their cash and holdings, and every held
+    symbol by how many users hold it, saving both for the leaderboard page.
+    Returns the number of users ranked.
+
+    The holdings are read in one pass grouped by symbol, every held symbol
+    is priced with one call to fetch_many(), and the positions are valued
+    and summed per user and per symbol with numpy, so the Python work grows
+    with the number of users and symbols rather than with the positions.
+    A symbol without a quote is valued at its cost basis.
+    """
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        # Read both tables from one snapshot, so no trade lands between them
+        connection.execute("BEGIN")
+        try:
+            users = connection.execute("SELECT id, username, cash FROM users ORDER BY id").fetchall()
+            groups = connection.execute("SELECT symbol, COUNT(*), group_concat(user_id), group_concat(shares), "
+                                        "group_concat(cost_basis) FROM holdings WHERE shares > 0 "
+                                        "GROUP BY symbol").fetchall()
+        finally:
+            connection.execute("COMMIT")
+
+        userIDs = np.array([user[0] for user in users], dtype=np.int64)
+        cash = np.array([user[2] for user in users], dtype=np.int64)
+
+        # One entry per position, with the index of its symbol; the concatenated columns list the rows in the same order
+        symbols = [group[0] for group in groups]
+        holders = np.array([group[1] for group in groups], dtype=np.int64)
+        symbolIndex = np.repeat(np.arange(len(groups)), holders)
+        owners, shares, costBasis = (np.concatenate([np.array(group[column].split(","), dtype=np.int64)
+                                                     for group in groups] or [np.array([], dtype=np.int64)])
+                                     for column in (2, 3, 4))
+
+        quotes = fetch_many(symbols) if symbols else {}
+        prices = np.array([Money.from_dollars(quotes[symbol]["price"]).cents if quotes.get(symbol) else -1
+                           for symbol in symbols], dtype=np.int64)
+        positionPrices = prices[symbolIndex]
+        values = np.where(positionPrices >= 0, shares * positionPrices, costBasis)
+
+        # Sum the positions per user and per symbol
+        userIndex = np.searchsorted(userIDs, owners)
+        holdingsValue = np.zeros(len(users), dtype=np.int64)
+        np.add.at(holdingsValue, userIndex, values)
+        userCostBasis = np.zeros(len(users), dtype=np.int64)
+        np.add.at(userCostBasis, userIndex, costBasis)
+        symbolShares = np.zeros(len(groups), dtype=np.int64)
+        np.add.at(symbolShares, symbolIndex, shares)
+        symbolValues = np.zeros(len(groups), dtype=np.int64)
+        np.add.at(symbolValues, symbolIndex, values)
+
+        # Richest first, and the most widely held symbols first; ties go to the earlier user or bigger holding
+        total = cash + holdingsValue
+        userOrder = np.lexsort((userIDs, -total))
+        symbolOrder = np.lexsort((-symbolValues, -holders))
+
+        computed = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        leaders = ((rank, int(userIDs[index]), users[index][1], int(cash[index]), int(holdingsValue[index]),
+                    int(userCostBasis[index]), int(total[index]))
+                   for rank, index in enumerate(userOrder.tolist(), start=1))
+        held = ((rank, symbols[index], int(holders[index]), int(symbolShares[index]), int(symbolValues[index]))
+                for rank, index in enumerate(symbolOrder.tolist(), start=1))
+
+        # Swap the new rankings in together; pages keep reading the old ones until the commit
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM leaderboard")
+            _write(connection, "INSERT INTO leaderboard (rank, user_id, username, cash, holdings_value, cost_basis, "
+                               "total) VALUES (?, ?, ?, ?, ?, ?, ?)", leaders)
+            connection.execute("DELETE FROM symbol_report")
+            _write(connection, "INSERT INTO symbol_report (rank, symbol, holders, shares, value) VALUES (?, ?, ?, ?, ?)",
+                   held)
+            connection.executemany("INSERT OR REPLACE INTO reports (name, computed, rows) VALUES (?, ?, ?)",
+                                   [("leaderboard", computed, len(users)), ("symbol_report", computed, len(groups))])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return len(users)
+    finally:
+        connection.close()
+
+
+def refresh_if_stale(path, fetch_many, max_age):
+    """
+    Refresh the rankings if they were last computed more than max_age
+    seconds ago, or never, returning the number of users ranked (0 if they
+    were fresh or another worker is refreshing them).
+
+    Several workers may run this job. The first to find the rankings stale
+    takes a lease on the run in report_leases inside a write transaction,
+    so the others leave them be; the computed time only changes when the new
+    rankings are saved. The lease is given up when the refresh ends, and
+    lapses after LEASE_SECONDS if the worker dies first.
+    """
+    now = datetime.now()
+    expires = (now + timedelta(seconds=LEASE_SECONDS)).strftime("%Y-%m-%d %H:%M:%S")
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT computed FROM reports WHERE name = 'leaderboard'").fetchone()
+            stale = row is None or time.time() - datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S").timestamp() >= max_age
+            if stale:
+                lease = connection.execute("SELECT expires FROM report_leases WHERE name = 'leaderboard'").fetchone()
+                stale = lease is None or lease[0] <= now.strftime("%Y-%m-%d %H:%M:%S")
+            if stale:
+                connection.execute("INSERT OR REPLACE INTO report_leases (name, expires) VALUES ('leaderboard', ?)",
+                                   (expires,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        if not stale:
+            return 0
+
+        try:
+            return refresh(path, fetch_many)
+        finally:
+            connection.execute("DELETE FROM report_leases WHERE name = 'leaderboard' AND expires = ?", (expires,))
+    finally:
+        connection.close()
+
+
+def _write(connection, sql, rows):
+    """Insert rows from an iterator in chunks, so the full list is never built."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == WRITE_CHUNK:
+            connection.executemany(sql, chunk)
+            chunk = []
+    connection.executemany(sql, chunk)
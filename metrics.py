@@ -0,0 +1,301 @@
+import hmac
+import os
+import sys
+import threading
+import time
+
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+from flask import Response, abort, before_render_template, g, has_request_context, request, template_rendered
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Addresses /metrics is served to when no token is set
+LOCAL_ADDRESSES = ("127.0.0.1", "::1")
+
+
+class Histogram:
+    """Count observations into the cumulative buckets Prometheus expects."""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """
+    Request, query and quote timings for the whole process.
+
+    Routes are timed as a whole and split into phases (db, quote, render);
+    counters from other parts of the app, such as the quote cache, are read
+    when the metrics are scraped. render() gives the Prometheus text format.
+    """
+
+    def __init__(self, prefix="finance"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)
+        self._durations = defaultdict(Histogram)
+        self._phases = defaultdict(Histogram)
+        self._queries = defaultdict(int)
+        self._collectors = {}
+
+    def observe_request(self, endpoint, method, status, seconds, queries):
+        """Record a finished request."""
+        with self._lock:
+            self._requests[(endpoint, method, status)] += 1
+            self._durations[endpoint].observe(seconds)
+            self._queries[endpoint] += queries
+
+    def observe_phase(self, phase, seconds):
+        """Record time spent in one phase, such as a query or a quote lookup."""
+        with self._lock:
+            self._phases[phase].observe(seconds)
+
+    def collect(self, name, stats, gauges=()):
+        """
+        Report the dict returned by stats() as metrics named after name
+        whenever metrics are scraped: the keys in gauges (and any string
+        state) as gauges, and the rest as counters that only ever go up.
+        """
+        self._collectors[name] = (stats, frozenset(gauges))
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        prefix = self.prefix
+        lines = []
+        with self._lock:
+            lines.append(f"# HELP {prefix}_requests_total Requests served, by endpoint, method and status.")
+            lines.append(f"# TYPE {prefix}_requests_total counter")
+            for (endpoint, method, status), count in sorted(self._requests.items()):
+                lines.append(f'{prefix}_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+
+            lines.append(f"# HELP {prefix}_request_duration_seconds Time taken to build each response, by endpoint.")
+            lines.append(f"# TYPE {prefix}_request_duration_seconds histogram")
+            for endpoint, histogram in sorted(self._durations.items()):
+                lines.extend(_histogram_lines(f"{prefix}_request_duration_seconds", f'endpoint="{endpoint}"', histogram))
+
+            lines.append(f"# HELP {prefix}_phase_duration_seconds Time spent on database queries, quote lookups and rendering.")
+            lines.append(f"# TYPE {prefix}_phase_duration_seconds histogram")
+            for phase, histogram in sorted(self._phases.items()):
+                lines.extend(_histogram_lines(f"{prefix}_phase_duration_seconds", f'phase="{phase}"', histogram))
+
+            lines.append(f"# HELP {prefix}_db_queries_total Database queries run by requests, by endpoint.")
+            lines.append(f"# TYPE {prefix}_db_queries_total counter")
+            for endpoint, count in sorted(self._queries.items()):
+                lines.append(f'{prefix}_db_queries_total{{endpoint="{endpoint}"}} {count}')
+
+        for name, (stats, gauges) in self._collectors.items():
+            for key, value in stats().items():
+                metric = f"{prefix}_{name}_{key}"
+                kind = "gauge" if key in gauges or isinstance(value, str) else "counter"
+                lines.append(f"# TYPE {metric} {kind}")
+
+                # States such as the circuit breaker's are reported as a label
+                if isinstance(value, str):
+                    lines.append(f'{metric}{{state="{value}"}} 1')
+                else:
+                    lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedSQL:
+    """Wrap a CS50 SQL handle so that every query is timed and counted."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def execute(self, *args, **kwargs):
+        with span("db"):
+            return self.db.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class SamplingProfiler:
+    """
+    Sample the stacks of threads serving requests.
+
+    While at least one thread is being profiled, a background thread records
+    its stack every interval seconds. stop() returns the samples as counts of
+    stacks, which dump() writes in the collapsed format flamegraph.pl and
+    speedscope read.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self, thread_id):
+        """Begin sampling the thread with the given id."""
+        with self._lock:
+            self._samples[thread_id] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def stop(self, thread_id):
+        """Stop sampling the thread, returning its stack counts."""
+        with self._lock:
+            return self._samples.pop(thread_id, Counter())
+
+    def dump(self, samples, path):
+        """Write samples to path as one "frame;frame;frame count" line per stack."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as file:
+            for stack, count in samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+    def _run(self):
+        while True:
+            with self._lock:
+                threadIDs = list(self._samples)
+            if not threadIDs:
+                # Sleep until there's a request to profile again
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            frames = sys._current_frames()
+            with self._lock:
+                for threadID in threadIDs:
+                    if threadID in frames and threadID in self._samples:
+                        self._samples[threadID][_collapse(frames[threadID])] += 1
+            time.sleep(self.interval)
+
+
+@contextmanager
+def span(phase):
+    """Time the block as one phase of the current request, as in `with span("quote"):`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(phase, time.perf_counter() - started)
+
+
+def timed(phase):
+    """Decorate a function so that each call is timed as a phase of the current request."""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with span(phase):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def init_app(app, slow_request_ms=None, profile_dir="profiles", profile_interval_ms=5, token=None):
+    """
+    Time every request to app, add a Server-Timing header to each response and
+    serve the metrics at /metrics.
+
+    The metrics are only served to requests bearing token, as in
+    "Authorization: Bearer <token>", or, without a token, to requests from
+    the same machine. With slow_request_ms set, every request is sampled by the profiler and the
+    profile of any taking longer than that is written to profile_dir.
+    """
+    profiler = SamplingProfiler(profile_interval_ms / 1000) if slow_request_ms else None
+
+    @app.before_request
+    def start_timing():
+        g.metrics_started = time.perf_counter()
+        g.metrics_phases = defaultdict(float)
+        g.metrics_queries = 0
+        if profiler:
+            profiler.start(threading.get_ident())
+
+    @app.after_request
+    def finish_timing(response):
+        if "metrics_started" not in g:
+            return response
+        elapsed = time.perf_counter() - g.metrics_started
+        endpoint = request.endpoint or "unknown"
+        metrics.observe_request(endpoint, request.method, response.status_code, elapsed, g.metrics_queries)
+
+        # Show the breakdown in the browser's developer tools
+        timings = [f'{phase};dur={seconds * 1000:.2f}' for phase, seconds in g.metrics_phases.items()]
+        timings.append(f'total;dur={elapsed * 1000:.2f};desc="{g.metrics_queries} queries"')
+        response.headers["Server-Timing"] = ", ".join(timings)
+
+        if profiler:
+            samples = profiler.stop(threading.get_ident())
+            if elapsed * 1000 >= slow_request_ms and samples:
+                name = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{endpoint}-{elapsed * 1000:.0f}ms.folded"
+                profiler.dump(samples, os.path.join(profile_dir, name))
+        return response
+
+    @app.teardown_request
+    def stop_profiling(exception):
+        # A request that failed before after_request still has to stop being sampled
+        if profiler:
+            profiler.stop(threading.get_ident())
+
+    def start_render(sender, template, context, **extra):
+        g.metrics_render_started = time.perf_counter()
+
+    def finish_render(sender, template, context, **extra):
+        if "metrics_render_started" in g:
+            _record("render", time.perf_counter() - g.pop("metrics_render_started"))
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(finish_render, app, weak=False)
+
+    @app.route("/metrics")
+    def metrics_endpoint():
+        """Serve the metrics in the Prometheus text format"""
+        if token:
+            if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+                abort(403)
+        elif request.remote_addr not in LOCAL_ADDRESSES:
+            abort(403)
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def _record(phase, seconds):
+    """Add time spent in a phase to the current request, if any, and to the process totals."""
+    metrics.observe_phase(phase, seconds)
+    if has_request_context() and "metrics_phases" in g:
+        g.metrics_phases[phase] += seconds
+        if phase == "db":
+            g.metrics_queries += 1
+
+
+def _histogram_lines(name, labels, histogram):
+    """Return the bucket, sum and count lines of one histogram."""
+    lines = [f'{name}_bucket{{{labels},le="{bound}"}} {count}' for bound, count in zip(BUCKETS, histogram.buckets)]
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.sum:.6f}")
+    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+def _collapse(frame):
+    """Return a frame's stack, outermost call first, as module:function names joined by semicolons."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# Process-wide metrics shared by every request
+metrics = Metrics()
@@ -0,0 +1,309 @@
+import sqlite3
+
+import holdings
+
+
+def _original_schema(connection):
+    """Create the tables finance.db was first distributed with, if they are missing."""
+    connection.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER, username TEXT NOT NULL, hash TEXT NOT NULL, \
+                       cash NUMERIC NOT NULL DEFAULT 10000.00, PRIMARY KEY(id))")
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS username ON users (username)")
+    connection.execute("CREATE TABLE IF NOT EXISTS transactions (transaction_no INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, \
+                       stock_symbol TEXT NOT NULL, cost NUMBER NOT NULL, shares_count INTEGER NOT NULL, time DATETIME NOT NULL)")
+
+
+def _integer_cents(connection):
+    """
+    Store money as whole cents.
+
+    users.cash and transactions.cost held floating-point dollars; both become
+    INTEGER columns of cents. The holdings table is dropped so that it is
+    rebuilt from the converted ledger.
+    """
+    # Both tables are converted in the same transaction, so cents in users.cash mean the ledger has them too
+    types = {row[1]: row[2] for row in connection.execute("PRAGMA table_info(users)")}
+    if types.get("cash") == "INTEGER":
+        return
+
+    connection.execute("CREATE TABLE users_cents (id INTEGER, username TEXT NOT NULL, hash TEXT NOT NULL, \
+                       cash INTEGER NOT NULL DEFAULT 1000000, PRIMARY KEY(id))")
+    connection.execute("INSERT INTO users_cents (id, username, hash, cash) \
+                       SELECT id, username, hash, CAST(ROUND(cash * 100) AS INTEGER) FROM users")
+    connection.execute("DROP TABLE users")
+    connection.execute("ALTER TABLE users_cents RENAME TO users")
+    connection.execute("CREATE UNIQUE INDEX username ON users (username)")
+
+    connection.execute("CREATE TABLE transactions_cents (transaction_no INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, \
+                       stock_symbol TEXT NOT NULL, cost INTEGER NOT NULL, shares_count INTEGER NOT NULL, \
+                       time DATETIME NOT NULL)")
+    connection.execute("INSERT INTO transactions_cents (transaction_no, user_id, stock_symbol, cost, shares_count, time) \
+                       SELECT transaction_no, user_id, stock_symbol, CAST(ROUND(cost * 100) AS INTEGER), shares_count, time \
+                       FROM transactions")
+    connection.execute("DROP TABLE transactions")
+    connection.execute("ALTER TABLE transactions_cents RENAME TO transactions")
+    connection.execute("CREATE UNIQUE INDEX transaction_no ON transactions (transaction_no)")
+
+    connection.execute("DROP TABLE IF EXISTS holdings")
+
+
+def _transaction_indexes(connection):
+    """
+    Index the ledger by user.
+
+    (user_id, stock_symbol, shares_count) covers per-user position sums and
+    (user_id, time) serves the history page in order. The unique index on
+    transaction_no duplicated the primary key and only slowed down inserts.
+    """
+    connection.execute("CREATE INDEX IF NOT EXISTS transactions_user_symbol ON transactions (user_id, stock_symbol, shares_count)")
+    connection.execute("CREATE INDEX IF NOT EXISTS transactions_user_time ON transactions (user_id, time)")
+    connection.execute("DROP INDEX IF EXISTS transaction_no")
+
+
+def _holdings_table(connection):
+    """Create the holdings table and fill it from the ledger."""
+    exists = connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='holdings'").fetchone()
+    if exists:
+        return
+
+    connection.execute("CREATE TABLE holdings (user_id INTEGER NOT NULL, symbol TEXT NOT NULL, shares INTEGER NOT NULL, "
+                       "cost_basis INTEGER NOT NULL, PRIMARY KEY(user_id, symbol))")
+
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute("SELECT user_id, stock_symbol, shares_count, cost FROM transactions ORDER BY transaction_no")
+        positions = holdings.replay(rows)
+    finally:
+        connection.row_factory = None
+
+    connection.executemany("INSERT INTO holdings (user_id, symbol, shares, cost_basis) VALUES(?, ?, ?, ?)",
+                           [(userID, symbol, shares, costBasis)
+                            for (userID, symbol), (shares, costBasis, realized) in positions.items() if shares])
+
+
+def _symbols_tables(connection):
+    """Create the tables behind the symbol directory."""
+    connection.execute("CREATE TABLE IF NOT EXISTS symbols (symbol TEXT PRIMARY KEY, name TEXT NOT NULL DEFAULT '', "
+                       "updated DATETIME NOT NULL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS symbols_staging (symbol TEXT PRIMARY KEY, name TEXT NOT NULL, "
+                       "updated DATETIME NOT NULL)")
+
+
+def _prices_table(connection):
+    """Create the table of daily closing prices, clustered by symbol and date."""
+    connection.execute("CREATE TABLE IF NOT EXISTS prices (symbol TEXT NOT NULL, date DATE NOT NULL, "
+                       "close INTEGER NOT NULL, PRIMARY KEY(symbol, date)) WITHOUT ROWID")
+
+
+def _realized_gains(connection):
+    """
+    Track the realized gain of each position.
+
+    Positions sold off entirely are now kept with no shares so that their
+    gains aren't lost, so holdings is refilled from the ledger.
+    """
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(holdings)")]
+    if "realized" not in columns:
+        connection.execute("ALTER TABLE holdings ADD COLUMN realized INTEGER NOT NULL DEFAULT 0")
+
+    connection.row_factory = sqlite3.Row
+    try:
+        rows = connection.execute("SELECT user_id, stock_symbol, shares_count, cost FROM transactions ORDER BY transaction_no")
+        positions = holdings.replay(rows)
+    finally:
+        connection.row_factory = None
+
+    connection.execute("DELETE FROM holdings")
+    connection.executemany("INSERT INTO holdings (user_id, symbol, shares, cost_basis, realized) VALUES(?, ?, ?, ?, ?)",
+                           [(userID, symbol, *position) for (userID, symbol), position in positions.items()])
+
+
+def _ledger_version(connection):
+    """
+    Count changes to each user's ledger.
+
+    users.ledger_version goes up with every transaction written for the user,
+    so pages built from the ledger can tell whether a browser's copy is current.
+    """
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(users)")]
+    if "ledger_version" not in columns:
+        connection.execute("ALTER TABLE users ADD COLUMN ledger_version INTEGER NOT NULL DEFAULT 0")
+    connection.execute("CREATE TRIGGER IF NOT EXISTS transactions_insert_version AFTER INSERT ON transactions BEGIN "
+                       "UPDATE users SET ledger_version = ledger_version + 1 WHERE id = NEW.user_id; END")
+    connection.execute("CREATE TRIGGER IF NOT EXISTS transactions_update_version AFTER UPDATE ON transactions BEGIN "
+                       "UPDATE users SET ledger_version = ledger_version + 1 WHERE id IN (OLD.user_id, NEW.user_id); END")
+    connection.execute("CREATE TRIGGER IF NOT EXISTS transactions_delete_version AFTER DELETE ON transactions BEGIN "
+                       "UPDATE users SET ledger_version = ledger_version + 1 WHERE id = OLD.user_id; END")
+
+
+def _orders_table(connection):
+    """Create the table of limit and stop orders."""
+    connection.execute("CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+                       "symbol TEXT NOT NULL, side TEXT NOT NULL, kind TEXT NOT NULL, shares INTEGER NOT NULL, "
+                       "trigger_price INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'open', created DATETIME NOT NULL, "
+                       "closed DATETIME, fill_price INTEGER, transaction_no INTEGER, note TEXT NOT NULL DEFAULT '')")
+
+    # The matcher only ever reads open orders; the orders page lists a user's newest first
+    connection.execute("CREATE INDEX IF NOT EXISTS orders_open ON orders (id) WHERE status='open'")
+    connection.execute("CREATE INDEX IF NOT EXISTS orders_user ON orders (user_id, id)")
+
+
+def _ledger_snapshots(connection):
+    """
+    Create the tables of ledger snapshots and archived transactions.
+
+    snapshots holds each user's cash as of a transaction and
+    snapshot_positions their positions then, so positions can be replayed
+    from there on. ledger_archive keeps transactions moved out of the live
+    ledger, compressed in chunks, and ledger_openings each user's cash and
+    shares just after the last of them.
+    """
+    connection.execute("CREATE TABLE IF NOT EXISTS snapshots (user_id INTEGER PRIMARY KEY, transaction_no INTEGER NOT NULL, "
+                       "time DATETIME NOT NULL, cash INTEGER NOT NULL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS snapshot_positions (user_id INTEGER NOT NULL, symbol TEXT NOT NULL, "
+                       "shares INTEGER NOT NULL, cost_basis INTEGER NOT NULL, realized INTEGER NOT NULL, "
+                       "PRIMARY KEY(user_id, symbol))")
+    connection.execute("CREATE TABLE IF NOT EXISTS ledger_archive (user_id INTEGER NOT NULL, first_no INTEGER NOT NULL, "
+                       "last_no INTEGER NOT NULL, rows INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY(user_id, first_no))")
+    connection.execute("CREATE TABLE IF NOT EXISTS ledger_openings (user_id INTEGER PRIMARY KEY, "
+                       "transaction_no INTEGER NOT NULL, time DATETIME NOT NULL, cash INTEGER NOT NULL, shares TEXT NOT NULL)")
+
+    # Finds the transactions since a user's snapshot without reading the ones before it
+    connection.execute("CREATE INDEX IF NOT EXISTS transactions_user_no ON transactions (user_id, transaction_no)")
+
+
+def _leaderboard(connection):
+    """
+    Create the tables the leaderboard job ranks users and symbols into.
+
+    leaderboard and symbol_report are keyed by rank, so a page of either is
+    read straight from its primary key; reports records when each was last
+    computed.
+    """
+    connection.execute("CREATE TABLE IF NOT EXISTS leaderboard (rank INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+                       "username TEXT NOT NULL, cash INTEGER NOT NULL, holdings_value INTEGER NOT NULL, "
+                       "cost_basis INTEGER NOT NULL, total INTEGER NOT NULL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS symbol_report (rank INTEGER PRIMARY KEY, symbol TEXT NOT NULL, "
+                       "holders INTEGER NOT NULL, shares INTEGER NOT NULL, value INTEGER NOT NULL)")
+    connection.execute("CREATE TABLE IF NOT EXISTS reports (name TEXT PRIMARY KEY, computed DATETIME NOT NULL, "
+                       "rows INTEGER NOT NULL)")
+
+    # Finds the signed-in user's own rank
+    connection.execute("CREATE INDEX IF NOT EXISTS leaderboard_user ON leaderboard (user_id)")
+
+
+def _drop_symbols_staging(connection):
+    """Drop the shared staging table symbol refreshes used to fill; each now fills a temporary table of its own."""
+    connection.execute("DROP TABLE IF EXISTS symbols_staging")
+
+
+def _ledger_import_guard(connection):
+    """
+    Let statement imports raise a user's ledger version once instead of once per row.
+
+    While an import holds the write lock it puts the user in ledger_imports,
+    and the insert trigger skips the users in it; the import takes them out
+    again before it commits, so no other connection ever sees them there.
+    """
+    connection.execute("CREATE TABLE IF NOT EXISTS ledger_imports (user_id INTEGER PRIMARY KEY)")
+    connection.execute("DROP TRIGGER IF EXISTS transactions_insert_version")
+    connection.execute("CREATE TRIGGER transactions_insert_version AFTER INSERT ON transactions "
+                       "WHEN NOT EXISTS (SELECT 1 FROM ledger_imports WHERE user_id = NEW.user_id) BEGIN "
+                       "UPDATE users SET ledger_version = ledger_version + 1 WHERE id = NEW.user_id; END")
+
+
+def _report_leases(connection):
+    """Create the table a worker claims a report's refresh in, until the lease expires or the refresh ends."""
+    connection.execute("CREATE TABLE IF NOT EXISTS report_leases (name TEXT PRIMARY KEY, expires DATETIME NOT NULL)")
+
+
+# Schema changes in the order they were made; PRAGMA user_version counts how many have been applied.
+# Each one must also be safe to run against a database that already has its changes.
+MIGRATIONS = [
+    _integer_cents,
+    _transaction_indexes,
+    _holdings_table,
+    _symbols_tables,
+    _prices_table,
+    _realized_gains,
+    _ledger_version,
+    _orders_table,
+    _ledger_snapshots,
+    _leaderboard,
+    _drop_symbols_staging,
+    _ledger_import_guard,
+    _report_leases,
+]
+
+# Queries run by the routes, by name, with sample parameters; each must be answered through an index
+ROUTE_QUERIES = {
+    "index: positions": ("SELECT symbol, shares, cost_basis, realized FROM holdings WHERE user_id = ? ORDER BY symbol", (1,)),
+    "index: cash": ("SELECT cash FROM users WHERE id = ?", (1,)),
+    "history": ("SELECT transaction_no, stock_symbol, shares_count, cost, time FROM transactions WHERE user_id = ? \
+                AND (time, transaction_no) < (?, ?) ORDER BY time DESC, transaction_no DESC LIMIT ?", (1, "2021-08-14 07:51:16", 32, 51)),
+    "history: export": ("SELECT transaction_no, stock_symbol, shares_count, cost, time FROM transactions WHERE user_id = ? \
+                        AND (time, transaction_no) > (?, ?) ORDER BY time, transaction_no LIMIT ?", (1, "2021-08-14 07:51:16", 32, 1000)),
+    "history: export archive": ("SELECT first_no, data FROM ledger_archive WHERE user_id = ? AND first_no > ? \
+                                ORDER BY first_no LIMIT 1", (1, 0)),
+    "ledger version": ("SELECT ledger_version FROM users WHERE id = ?", (1,)),
+    "orders": ("SELECT id, symbol, side, kind, shares, trigger_price, status, created, fill_price, note FROM orders \
+               WHERE user_id = ? ORDER BY id DESC LIMIT ?", (1, 100)),
+    "orders: matcher": ("SELECT id, user_id, symbol, side, kind, shares, trigger_price FROM orders \
+                        WHERE status='open' AND id > ? ORDER BY id", (0,)),
+    "orders: matcher still open": ("SELECT id FROM orders WHERE status='open' AND id <= ?", (0,)),
+    "login": ("SELECT id, username, hash FROM users WHERE username = ?", ("john",)),
+    "leaderboard": ("SELECT rank, username, cash, holdings_value, cost_basis, total FROM leaderboard \
+                    WHERE rank > ? ORDER BY rank LIMIT ?", (0, 51)),
+    "leaderboard: own rank": ("SELECT rank, total FROM leaderboard WHERE user_id = ?", (1,)),
+    "leaderboard: symbols": ("SELECT rank, symbol, holders, shares, value FROM symbol_report \
+                             WHERE rank > ? ORDER BY rank LIMIT ?", (0, 20)),
+    "leaderboard: computed": ("SELECT computed FROM reports WHERE name = ?", ("leaderboard",)),
+    "sell: position": ("SELECT shares FROM holdings WHERE user_id = ? AND symbol = ? AND shares > 0", (1, "AAPL")),
+    "sell: symbols": ("SELECT symbol FROM holdings WHERE user_id = ? AND shares > 0 ORDER BY symbol", (1,)),
+}
+
+
+def migrate(path):
+    """Apply any migrations the database at path hasn't had yet, returning how many ran."""
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+
+        # A new, empty database starts from the original schema and is migrated like any other
+        if version == 0:
+            _original_schema(connection)
+
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            # Each migration and its version bump commit together
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                migration(connection)
+                connection.execute(f"PRAGMA user_version = {number}")
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return len(MIGRATIONS) - min(version, len(MIGRATIONS))
+    finally:
+        connection.close()
+
+
+def check_query_plans(path, queries=ROUTE_QUERIES):
+    """
+    Run EXPLAIN QUERY PLAN for each query, returning {name: plan} for those
+    that scan a whole table or sort in a temporary b-tree instead of using an index.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        problems = {}
+        for name, (sql, parameters) in queries.items():
+            plan = [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + sql, parameters)]
+            if any(_is_full_scan(step) or step.startswith("USE TEMP B-TREE") for step in plan):
+                problems[name] = plan
+        return problems
+    finally:
+        connection.close()
+
+
+def _is_full_scan(step):
+    """Tell whether a query plan step reads every row of a table or index."""
+    return step.startswith("SCAN ") and "CONSTANT ROW" not in step
@@ -0,0 +1,98 @@
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import total_ordering
+
+# One cent as a Decimal, for rounding dollar amounts
+CENT = Decimal("0.01")
+
+# The most a user can type in as one amount, far below the 2**63 cents an SQLite INTEGER holds
+MAX_DOLLARS = Decimal(10) ** 12
+
+
+def format_cents(cents):
+    """Format a whole number of cents as US dollars, such as $1,234.56 or -$0.50."""
+    # Formatting with the format mini-language is thread-safe, unlike locale.currency()
+    if cents < 0:
+        return f"-${-cents // 100:,}.{-cents % 100:02d}"
+    return f"${cents // 100:,}.{cents % 100:02d}"
+
+
+@total_ordering
+class Money:
+    """An exact amount of US dollars, kept as a whole number of cents."""
+
+    __slots__ = ("cents",)
+
+    def __init__(self, cents=0):
+        if isinstance(cents, Money):
+            cents = cents.cents
+        self.cents = int(cents)
+
+    @classmethod
+    def from_dollars(cls, dollars):
+        """Convert a dollar amount (as from the quote API) to Money, rounding to the nearest cent."""
+        if isinstance(dollars, float):
+            dollars = repr(dollars)
+        return cls(Decimal(dollars).quantize(CENT, rounding=ROUND_HALF_UP) * 100)
+
+    @classmethod
+    def parse(cls, text):
+        """Read an amount typed by a user, rejecting anything finer than a cent or larger than MAX_DOLLARS."""
+        try:
+            dollars = Decimal(text.strip().lstrip("$").replace(",", ""))
+            if not dollars.is_finite() or abs(dollars) > MAX_DOLLARS or dollars != dollars.quantize(CENT):
+                raise ValueError(f"not an amount of money: {text!r}")
+        except (AttributeError, InvalidOperation):
+            raise ValueError(f"not an amount of money: {text!r}")
+        return cls(dollars * 100)
+
+    @property
+    def dollars(self):
+        """The amount in dollars, as an exact Decimal."""
+        return Decimal(self.cents).scaleb(-2)
+
+    def __add__(self, other):
+        return Money(self.cents + Money(other).cents)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return Money(self.cents - Money(other).cents)
+
+    def __rsub__(self, other):
+        return Money(Money(other).cents - self.cents)
+
+    def __mul__(self, quantity):
+        if not isinstance(quantity, int):
+            return NotImplemented
+        return Money(self.cents * quantity)
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __abs__(self):
+        return Money(abs(self.cents))
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __eq__(self, other):
+        if isinstance(other, (Money, int)):
+            return self.cents == Money(other).cents
+        return NotImplemented
+
+    def __lt__(self, other):
+        if isinstance(other, (Money, int)):
+            return self.cents < Money(other).cents
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __str__(self):
+        """Format as US dollars, such as $1,234.56 or -$0.50."""
+        return format_cents(self.cents)
+
+    def __repr__(self):
+        return f"Money({self.cents})"
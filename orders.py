@@ -0,0 +1,191 @@
+import heapq
+import logging
+import threading
+
+from datetime import datetime
+
+import trades
+from money import Money
+
+# Symbols priced per quote request while matching
+BATCH_SIZE = 100
+
+# Order sides and kinds users can choose from
+SIDES = ["buy", "sell"]
+KINDS = ["limit", "stop"]
+
+
+def triggers_on_fall(order):
+    """
+    Tell whether an order fills once the price falls to its trigger price
+    (limit buys and stop sells) rather than once it rises to it (limit sells
+    and stop buys).
+    """
+    return (order["side"] == "buy") == (order["kind"] == "limit")
+
+
+class OrderBook:
+    """
+    Open orders, indexed by the price that triggers them.
+
+    Each symbol has two heaps: orders that fill when the price falls to their
+    trigger price, highest trigger first, and orders that fill when it rises
+    to theirs, lowest trigger first. Checking a price only pops the orders it
+    crosses, so the work done per tick grows with the orders filled rather
+    than the orders resting. Removed orders are dropped from the heaps lazily.
+    """
+
+    def __init__(self):
+        self._orders = {}
+        self._falling = {}
+        self._rising = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    def add(self, order):
+        """Add an order (a dict with id, symbol, side, kind and trigger_price in cents)."""
+        with self._lock:
+            if order["id"] not in self._orders:
+                self._counts[order["symbol"]] = self._counts.get(order["symbol"], 0) + 1
+            self._orders[order["id"]] = order
+            if triggers_on_fall(order):
+                heapq.heappush(self._falling.setdefault(order["symbol"], []), (-order["trigger_price"], order["id"]))
+            else:
+                heapq.heappush(self._rising.setdefault(order["symbol"], []), (order["trigger_price"], order["id"]))
+
+    def remove(self, order_id):
+        """Take an order out of the book, returning it or None."""
+        with self._lock:
+            return self._take(order_id)
+
+    def ids(self):
+        """Return the ids of the orders in the book."""
+        with self._lock:
+            return set(self._orders)
+
+    def symbols(self):
+        """Return the symbols with open orders."""
+        with self._lock:
+            return sorted(symbol for symbol, count in self._counts.items() if count)
+
+    def crossing(self, symbol, price):
+        """Remove and return the orders for symbol that a price (in cents) triggers."""
+        crossed = []
+        with self._lock:
+            falling = self._falling.get(symbol, [])
+            while falling and -falling[0][0] >= price:
+                crossed.append(heapq.heappop(falling)[1])
+
+            rising = self._rising.get(symbol, [])
+            while rising and rising[0][0] <= price:
+                crossed.append(heapq.heappop(rising)[1])
+
+            # Orders already removed from the book are skipped here
+            return [order for order in map(self._take, crossed) if order is not None]
+
+    def _take(self, order_id):
+        order = self._orders.pop(order_id, None)
+        if order is not None:
+            self._counts[order["symbol"]] -= 1
+        return order
+
+
+class OrderMatcher:
+    """
+    Fill limit and stop orders as prices reach them.
+
+    Each tick picks up orders placed since the last one, prices every symbol
+    with open orders through fetch_many() in batches of BATCH_SIZE and fills
+    the orders each price triggers at that price through trades.fill_order().
+    Orders are claimed in the database as they fill, so several workers can
+    run a matcher over the same orders without filling any twice.
+    """
+
+    def __init__(self, db, fetch_many):
+        self.db = db
+        self.fetch_many = fetch_many
+        self.book = OrderBook()
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Add open orders placed since the last load to the book, and drop
+        those that were cancelled or filled elsewhere since.
+        """
+        still_open = {row["id"] for row in self.db.execute("SELECT id FROM orders WHERE status='open' AND id <= ?",
+                                                            self._last_id)}
+        for orderID in self.book.ids() - still_open:
+            self.book.remove(orderID)
+
+        rows = self.db.execute("SELECT id, user_id, symbol, side, kind, shares, trigger_price FROM orders \
+                               WHERE status='open' AND id > ? ORDER BY id", self._last_id)
+        for row in rows:
+            self.book.add(row)
+        if rows:
+            self._last_id = rows[-1]["id"]
+        return len(rows)
+
+    def tick(self):
+        """Price every symbol with open orders and fill the orders that cross, returning how many filled."""
+        # Ticks mustn't overlap, or an order could be popped by one and re-added by the other
+        with self._lock:
+            self.load()
+            symbols = self.book.symbols()
+            filled = 0
+            for start in range(0, len(symbols), BATCH_SIZE):
+                quotes = self.fetch_many(symbols[start:start + BATCH_SIZE])
+                for symbol, quote in quotes.items():
+                    if not quote:
+                        continue
+                    price = Money.from_dollars(quote["price"])
+                    for order in self.book.crossing(symbol, price.cents):
+                        filled += self._fill(order, price)
+            return filled
+
+    def _fill(self, order, price):
+        """Fill one order at price, returning 1 if it filled."""
+        shares = order["shares"] if order["side"] == "buy" else -order["shares"]
+        try:
+            trades.fill_order(self.db, order["id"], order["user_id"], order["symbol"], shares, price)
+            return 1
+        except trades.OrderClosed:
+            # Cancelled, or filled by another worker's matcher
+            return 0
+        except trades.TradeError as e:
+            # The user can no longer afford the purchase or no longer holds the shares
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.db.execute("UPDATE orders SET status='rejected', closed=?, note=? WHERE id=? AND status='open'",
+                            now, str(e), order["id"])
+            return 0
+        except RuntimeError as e:
+            logging.getLogger(__name__).exception("order %s could not be filled", order["id"])
+            if trades.is_busy(e):
+                # The database stayed busy; try again next tick
+                self.book.add(order)
+            else:
+                # Anything else would fail the same way every tick, so the order is closed
+                now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                self.db.execute("UPDATE orders SET status='rejected', closed=?, note=? WHERE id=? AND status='open'",
+                                now, "The order could not be filled.", order["id"])
+            return 0
+
+
+def place(db, user_id, symbol, side, kind, shares, trigger_price):
+    """Save a new open order, with trigger_price as Money, returning its id."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return db.execute("INSERT INTO orders (user_id, symbol, side, kind, shares, trigger_price, created) \
+                      VALUES(?, ?, ?, ?, ?, ?, ?)", user_id, symbol, side, kind, shares, trigger_price.cents, now)
+
+
+def cancel(db, user_id, order_id):
+    """Cancel one of the user's open orders, returning False if there was no such order."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return db.execute("UPDATE orders SET status='cancelled', closed=? WHERE id=? AND user_id=? AND status='open'",
+                      now, order_id, user_id) == 1
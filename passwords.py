@@ -0,0 +1,161 @@
+import multiprocessing
+import threading
+import time
+
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from metrics import span
+
+# Method and parameters new password hashes are made with (werkzeug's default)
+HASH_METHOD = "scrypt:32768:8:1"
+
+
+class Busy(Exception):
+    """Too many passwords are already waiting to be hashed."""
+
+
+class PasswordHasher:
+    """
+    Hash and check passwords in a pool of worker processes.
+
+    Password hashes are slow on purpose and hold the GIL while they run, so
+    computing them in a request thread stalls every other request the worker
+    is serving. Here each one runs in one of workers processes while the
+    request thread waits without the GIL. At most max_pending hashes may be
+    queued or running at once; past that, hash() and check() raise Busy
+    straight away instead of making the caller wait behind a login storm.
+    With workers=0 hashes are computed in the calling thread.
+    """
+
+    def __init__(self, method=HASH_METHOD, workers=2, max_pending=16):
+        self.method = method
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = 0
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+        # werkzeug fills in defaults missing from method, so compare stored hashes with what it actually writes
+        self._prefix = generate_password_hash("", method).split("$", 1)[0]
+
+    def hash(self, password):
+        """Return a hash of password made with the current method."""
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, password_hash, password):
+        """Tell whether password matches password_hash."""
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Tell whether password_hash was made with another method or other parameters than the current ones."""
+        return password_hash.split("$", 1)[0] != self._prefix
+
+    def stats(self):
+        """Return the hashed/rejected counters and how many hashes are pending."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["pending"] = self._pending
+        return stats
+
+    def close(self):
+        """Stop the worker processes."""
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def _pool(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    # Forking a process that runs threads can copy held locks, so start the workers afresh
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _submit(self, func, *args):
+        """Run func(*args) in the pool, starting a new pool once if a worker has died."""
+        executor = self._pool()
+        try:
+            return executor.submit(func, *args).result()
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            return self._pool().submit(func, *args).result()
+
+    def _run(self, func, *args):
+        """Call func(*args) in the pool, or raise Busy if max_pending calls are already waiting."""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._counters["rejected"] += 1
+                raise Busy()
+            self._pending += 1
+        try:
+            with span("hash"):
+                if not self.workers:
+                    result = func(*args)
+                else:
+                    result = self._submit(func, *args)
+            self._count("hashed")
+            return result
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+
+class Throttle:
+    """
+    Allow each key (such as an IP address or a username) at most limit
+    attempts within any window seconds.
+
+    Attempts are kept per key as a queue of times, dropped once they're older
+    than the window, so memory grows with the keys seen in the last window.
+    A limit of 0 allows everything.
+    """
+
+    def __init__(self, limit=10, window=60):
+        self.limit = limit
+        self.window = window
+        self._attempts = {}
+        self._lock = threading.Lock()
+        self._next_sweep = 0
+
+    def attempt(self, *keys):
+        """
+        Record an attempt against every key and return 0, or if any key is
+        over its limit record nothing and return the seconds until it isn't.
+        """
+        if not self.limit:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            wait = 0
+            for key in keys:
+                attempts = self._attempts.get(key)
+                if attempts is None:
+                    continue
+                while attempts and attempts[0] <= now - self.window:
+                    attempts.popleft()
+                if len(attempts) >= self.limit:
+                    wait = max(wait, attempts[0] + self.window - now)
+            if wait:
+                return wait
+            for key in keys:
+                self._attempts.setdefault(key, deque()).append(now)
+            return 0
+
+    def _sweep(self, now):
+        """Forget the keys with no attempts left in the window, at most once per window."""
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.window
+        self._attempts = {key: attempts for key, attempts in self._attempts.items()
+                          if attempts and attempts[-1] > now - self.window}
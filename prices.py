@@ -0,0 +1,146 @@
+import csv
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from money import Money
+
+# Rows written per executemany() call while importing
+IMPORT_CHUNK = 5000
+
+
+def import_csv(path, file, symbol=None):
+    """
+    Load daily closing prices from a CSV file into the prices table.
+
+    The file needs Date and Close columns, as in the history files most data
+    providers offer. The symbol comes from a Symbol column if there is one,
+    then the symbol argument, then the file's name (AAPL.csv holds AAPL).
+    Returns the number of prices saved.
+    """
+    defaultSymbol = (symbol or os.path.splitext(os.path.basename(file.name))[0]).upper()
+
+    def rows():
+        for row in csv.DictReader(file):
+            # Providers differ in capitalisation of the header row
+            row = {key.strip().lower(): value for key, value in row.items() if key}
+            close = row.get("close") or row.get("adj close")
+            if not close or close.strip().lower() in ["", "null", "nan"]:
+                continue
+            yield ((row.get("symbol") or defaultSymbol).upper(), row["date"][:10], Money.from_dollars(close.strip()).cents)
+
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        count = 0
+        chunk = []
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for row in rows():
+                chunk.append(row)
+                if len(chunk) == IMPORT_CHUNK:
+                    connection.executemany("INSERT OR REPLACE INTO prices (symbol, date, close) VALUES(?, ?, ?)", chunk)
+                    count += len(chunk)
+                    chunk = []
+            connection.executemany("INSERT OR REPLACE INTO prices (symbol, date, close) VALUES(?, ?, ?)", chunk)
+            count += len(chunk)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return count
+    finally:
+        connection.close()
+
+
+def portfolio_values(path, user_id, start=None, end=None):
+    """
+    Work out the user's portfolio value (cash plus shares at the closing price)
+    for every trading day with prices between start and end.
+
+    Returns (dates, values) as numpy arrays of datetime64[D] and cents.
+    """
+    connection = sqlite3.connect(path)
+    try:
+        ledger = connection.execute("SELECT time, stock_symbol, shares_count, cost FROM transactions WHERE user_id=? \
+                                    ORDER BY time, transaction_no", (user_id,)).fetchall()
+        cashRow = connection.execute("SELECT cash FROM users WHERE id=?", (user_id,)).fetchone()
+
+        # Transactions archived out of the ledger are summed up by the shares held after them
+        opening = connection.execute("SELECT time, shares FROM ledger_openings WHERE user_id=?", (user_id,)).fetchone()
+        if (not ledger and opening is None) or cashRow is None:
+            return np.array([], dtype="datetime64[D]"), np.array([], dtype=np.int64)
+        openingShares = json.loads(opening[1]) if opening else {}
+
+        tradeDates = np.array([row[0][:10] for row in ledger], dtype="datetime64[D]")
+        tradeSymbols = np.array([row[1] for row in ledger], dtype=str)
+        shares = np.array([row[2] for row in ledger], dtype=np.int64)
+        costs = np.array([row[3] for row in ledger], dtype=np.int64)
+
+        # Deposits add their amount; trades move price * shares out of (or back into) cash
+        isDeposit = tradeSymbols == "DEPOSIT"
+        cashDeltas = np.where(isDeposit, costs, -costs * shares)
+
+        # Cash before the first ledger entry is whatever the ledger doesn't explain
+        startingCash = cashRow[0] - cashDeltas.sum()
+
+        # Load closing prices for every symbol the user ever traded
+        symbols = np.unique(np.concatenate([tradeSymbols[~isDeposit], np.array(list(openingShares), dtype=str)]))
+        start = np.datetime64(start or (opening[0][:10] if opening else tradeDates[0]), "D")
+        end = np.datetime64(end, "D") if end else None
+        priceRows = _load_prices(connection, symbols.tolist(), str(start), str(end) if end is not None else None)
+    finally:
+        connection.close()
+
+    if not priceRows:
+        return np.array([], dtype="datetime64[D]"), np.array([], dtype=np.int64)
+
+    priceSymbols, priceDates, closes = (np.array(column) for column in zip(*priceRows))
+    priceDates = priceDates.astype("datetime64[D]")
+
+    # One row per trading day, one column per symbol
+    dates = np.unique(priceDates)
+    dayIndex = np.searchsorted(dates, priceDates)
+    symbolIndex = np.searchsorted(symbols, priceSymbols)
+    closeMatrix = np.full((len(dates), len(symbols)), -1, dtype=np.int64)
+    closeMatrix[dayIndex, symbolIndex] = closes.astype(np.int64)
+    closeMatrix = _forward_fill(closeMatrix)
+
+    # Shares held and cash at the end of each day, from the running totals of the ledger
+    tradeDays = np.searchsorted(dates, tradeDates)
+    inRange = tradeDays < len(dates)
+    trades = inRange & ~isDeposit
+    shareDeltas = np.zeros((len(dates), len(symbols)), dtype=np.int64)
+    np.add.at(shareDeltas, (tradeDays[trades], np.searchsorted(symbols, tradeSymbols[trades])), shares[trades])
+    openingIndex = np.searchsorted(symbols, np.array(list(openingShares), dtype=str))
+    shareDeltas[0, openingIndex] += np.array(list(openingShares.values()), dtype=np.int64)
+    sharesHeld = np.cumsum(shareDeltas, axis=0)
+
+    dailyCash = np.zeros(len(dates), dtype=np.int64)
+    np.add.at(dailyCash, tradeDays[inRange], cashDeltas[inRange])
+    cash = startingCash + np.cumsum(dailyCash)
+
+    values = cash + (sharesHeld * closeMatrix).sum(axis=1)
+    return dates, values
+
+
+def _load_prices(connection, symbols, start, end):
+    """Return (symbol, date, close) rows for symbols between start and end."""
+    if not symbols:
+        return []
+    placeholders = ", ".join(["?"] * len(symbols))
+    sql = f"SELECT symbol, date, close FROM prices WHERE symbol IN ({placeholders}) AND date >= ?"
+    parameters = symbols + [start]
+    if end is not None:
+        sql += " AND date <= ?"
+        parameters.append(end)
+    return connection.execute(sql, parameters).fetchall()
+
+
+def _forward_fill(matrix):
+    """Replace missing (-1) prices with the symbol's previous close, or 0 before its first one."""
+    rows = np.arange(matrix.shape[0])[:, None]
+    lastKnown = np.maximum.accumulate(np.where(matrix >= 0, rows, 0), axis=0)
+    filled = matrix[lastKnown, np.arange(matrix.shape[1])]
+    return np.where(filled >= 0, filled, 0)
@@ -0,0 +1,158 @@
+import sqlite3
+import threading
+
+from metrics import span
+
+# Prepared statements each connection keeps; more than there are queries here, so none is ever prepared twice
+CACHED_STATEMENTS = 256
+
+
+class Repository:
+    """
+    The queries the routes run against users, transactions, holdings, orders and the leaderboard.
+
+    They go straight to sqlite3 rather than through the CS50 library, which
+    parses and rewrites every statement before SQLAlchemy runs it. Each
+    thread opens its own connection on first use and keeps it. Every
+    statement is a fixed string, so each connection prepares it once and
+    reuses it from its statement cache. Rows are sqlite3.Row objects, read by
+    column name like the CS50 library's dicts.
+    """
+
+    def __init__(self, path, mmap_size=256 * 1024 * 1024, cache_size=16 * 1024 * 1024):
+        self.path = path
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self._local = threading.local()
+
+    def _connection(self):
+        """Return this thread's connection to the database."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode; trades.py still writes through the CS50 library inside its own transactions
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None,
+                                         cached_statements=CACHED_STATEMENTS)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+
+            # A negative cache_size is in KiB rather than pages
+            connection.execute(f"PRAGMA cache_size={-int(self.cache_size // 1024)}")
+            self._local.connection = connection
+        return connection
+
+    def _all(self, sql, *parameters):
+        with span("db"):
+            return self._connection().execute(sql, parameters).fetchall()
+
+    def _one(self, sql, *parameters):
+        with span("db"):
+            return self._connection().execute(sql, parameters).fetchone()
+
+    # users
+
+    def user_by_name(self, username):
+        """Return the user's id, username and password hash, or None."""
+        return self._one("SELECT id, username, hash FROM users WHERE username = ?", username)
+
+    def add_user(self, username, password_hash):
+        """Register a user with the default starting cash, returning their id."""
+        with span("db"):
+            return self._connection().execute("INSERT INTO users (username, hash) VALUES (?, ?)",
+                                              (username, password_hash)).lastrowid
+
+    def set_password_hash(self, user_id, password_hash):
+        """Replace the user's password hash."""
+        with span("db"):
+            self._connection().execute("UPDATE users SET hash = ? WHERE id = ?", (password_hash, user_id))
+
+    def cash(self, user_id):
+        """Return the user's cash in cents."""
+        return self._one("SELECT cash FROM users WHERE id = ?", user_id)[0]
+
+    def ledger_version(self, user_id):
+        """Return the number bumped by every change to the user's transactions."""
+        return self._one("SELECT ledger_version FROM users WHERE id = ?", user_id)[0]
+
+    # holdings
+
+    def positions(self, user_id):
+        """Return the user's holdings, including those sold off, by symbol."""
+        return self._all("SELECT symbol, shares, cost_basis, realized FROM holdings WHERE user_id = ? ORDER BY symbol",
+                         user_id)
+
+    def held_symbols(self, user_id):
+        """Return the symbols the user holds shares of, in order."""
+        return [row[0] for row in
+                self._all("SELECT symbol FROM holdings WHERE user_id = ? AND shares > 0 ORDER BY symbol", user_id)]
+
+    def shares_held(self, user_id, symbol):
+        """Return how many shares of symbol the user holds, or 0."""
+        row = self._one("SELECT shares FROM holdings WHERE user_id = ? AND symbol = ? AND shares > 0", user_id, symbol)
+        return row[0] if row else 0
+
+    # transactions
+
+    def history_page(self, user_id, limit, before=None):
+        """
+        Return up to limit of the user's transactions, newest first, starting
+        after before, the (time, transaction_no) of the last one already shown.
+        """
+        if before is None:
+            return self._all("SELECT transaction_no, stock_symbol, shares_count, cost, time FROM transactions "
+                             "WHERE user_id = ? ORDER BY time DESC, transaction_no DESC LIMIT ?", user_id, limit)
+        return self._all("SELECT transaction_no, stock_symbol, shares_count, cost, time FROM transactions "
+                         "WHERE user_id = ? AND (time, transaction_no) < (?, ?) "
+                         "ORDER BY time DESC, transaction_no DESC LIMIT ?", user_id, *before, limit)
+
+    def ledger(self, user_id, limit, after=None):
+        """
+        Return up to limit of the user's transactions, oldest first, starting
+        after after, the (time, transaction_no) of the last one already read.
+        """
+        if after is None:
+            return self._all("SELECT transaction_no, stock_symbol, shares_count, cost, time FROM transactions "
+                             "WHERE user_id = ? ORDER BY time, transaction_no LIMIT ?", user_id, limit)
+        return self._all("SELECT transaction_no, stock_symbol, shares_count, cost, time FROM transactions "
+                         "WHERE user_id = ? AND (time, transaction_no) > (?, ?) ORDER BY time, transaction_no LIMIT ?",
+                         user_id, *after, limit)
+
+    def archived(self, user_id):
+        """
+        Yield the compressed chunks of the user's archived transactions,
+        oldest first, reading one at a time so that only one is ever held.
+        """
+        row = self._one("SELECT first_no, data FROM ledger_archive WHERE user_id = ? ORDER BY first_no LIMIT 1", user_id)
+        while row is not None:
+            yield row["data"]
+            row = self._one("SELECT first_no, data FROM ledger_archive WHERE user_id = ? AND first_no > ? "
+                            "ORDER BY first_no LIMIT 1", user_id, row["first_no"])
+
+    # orders
+
+    def orders_page(self, user_id, limit):
+        """Return up to limit of the user's orders, newest first."""
+        return self._all("SELECT id, symbol, side, kind, shares, trigger_price, status, created, fill_price, note "
+                         "FROM orders WHERE user_id = ? ORDER BY id DESC LIMIT ?", user_id, limit)
+
+    # leaderboard
+
+    def leaderboard_page(self, limit, after=0):
+        """Return up to limit users from the leaderboard, starting after the given rank."""
+        return self._all("SELECT rank, username, cash, holdings_value, cost_basis, total FROM leaderboard "
+                         "WHERE rank > ? ORDER BY rank LIMIT ?", after, limit)
+
+    def leaderboard_rank(self, user_id):
+        """Return the user's rank and total on the leaderboard, or None if they weren't ranked."""
+        return self._one("SELECT rank, total FROM leaderboard WHERE user_id = ?", user_id)
+
+    def symbol_report_page(self, limit, after=0):
+        """Return up to limit of the most widely held symbols, starting after the given rank."""
+        return self._all("SELECT rank, symbol, holders, shares, value FROM symbol_report "
+                         "WHERE rank > ? ORDER BY rank LIMIT ?", after, limit)
+
+    def report_computed(self, name):
+        """Return when the named report was last computed, or None."""
+        row = self._one("SELECT computed FROM reports WHERE name = ?", name)
+        return row[0] if row else None
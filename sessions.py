@@ -0,0 +1,129 @@
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+
+class SQLiteSession(CallbackDict, SessionMixin):
+    """
+    A session whose data lives in the database; the cookie only holds its id.
+
+    The session moves to a new id when it is cleared, or when it is saved
+    with a different user_id from the one it was opened with, however that
+    was changed, as on logging in and out, so an id someone else planted or
+    saw before then can't be used to act as the user afterwards.
+    """
+
+    def __init__(self, initial=None, sid=None, expires=0, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.new = new
+        self.modified = False
+        self.replaced = None
+        self.opened_user_id = self.get("user_id")
+
+    def clear(self):
+        super().clear()
+        self.rotate()
+
+    def rotate(self):
+        """Give the session a new id, keeping the one it was opened with in replaced so its row can go."""
+        # A new session's id hasn't been stored or sent to anyone yet
+        if not self.new and self.replaced is None:
+            self.replaced = self.sid
+            self.sid = secrets.token_urlsafe(32)
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """
+    Keep sessions in a table of a SQLite file that every worker shares.
+
+    A session is saved when it changes, or when more than half of its
+    lifetime (the app's PERMANENT_SESSION_LIFETIME) has passed so that active
+    users stay logged in. Expired sessions are deleted at most once every
+    sweep_interval seconds.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, path, sweep_interval=3600):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._swept = 0
+        self._local = threading.local()
+
+        # Create the table up front so every worker sees the same schema
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                           "expires REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+
+    def _connection(self):
+        """Return this thread's connection to the session file."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode; WAL lets readers carry on while another worker writes
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            row = self._connection().execute("SELECT data, expires FROM sessions WHERE id=? AND expires > ?",
+                                             (sid, time.time())).fetchone()
+            if row is not None:
+                return SQLiteSession(self.serializer.loads(row[0]), sid, row[1])
+
+        # Unknown or expired; start afresh under a new unguessable id
+        return SQLiteSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        connection = self._connection()
+        now = time.time()
+
+        # Logging in or out, by any means of changing the session, moves it to a new id
+        if session.get("user_id") != session.opened_user_id:
+            session.rotate()
+
+        # The row under the id the session had before it moved to a new one
+        if session.replaced is not None:
+            connection.execute("DELETE FROM sessions WHERE id=?", (session.replaced,))
+
+        # An emptied session (such as after logging out) is removed along with its cookie
+        if not session:
+            if session.modified and not session.new:
+                connection.execute("DELETE FROM sessions WHERE id=?", (session.sid,))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if session.modified or session.expires - now < lifetime / 2:
+            connection.execute("INSERT OR REPLACE INTO sessions (id, data, expires) VALUES (?, ?, ?)",
+                               (session.sid, self.serializer.dumps(dict(session)), now + lifetime))
+            self._sweep(connection, now)
+
+        if session.new or session.modified or self.should_set_cookie(app, session):
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def _sweep(self, connection, now):
+        """Delete expired sessions if that hasn't been done for a while."""
+        if now - self._swept < self.sweep_interval:
+            return
+        self._swept = now
+        connection.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
@@ -0,0 +1,174 @@
+import json
+import zlib
+
+import holdings
+from money import Money
+
+# Users checkpointed or archived per write transaction, so trades never wait on more than one batch
+BATCH_SIZE = 200
+
+# Archived transactions compressed together into one row of ledger_archive
+ARCHIVE_CHUNK = 1000
+
+
+def cash_change(transaction):
+    """Return how much a ledger row moved the user's cash, in cents."""
+    if transaction["stock_symbol"] == "DEPOSIT":
+        return transaction["cost"]
+    return -transaction["cost"] * transaction["shares_count"]
+
+
+def checkpoint(db, user_ids=None):
+    """
+    Snapshot the cash and positions of every user with transactions since
+    their last snapshot, or just of user_ids, returning how many were taken.
+
+    Each snapshot is the previous one with only the transactions since
+    replayed on top, so its cost depends on the user's recent activity
+    rather than the age of their account.
+    """
+    if user_ids is None:
+        user_ids = [row["id"] for row in db.execute(
+            "SELECT id FROM users WHERE EXISTS (SELECT 1 FROM transactions WHERE transactions.user_id = users.id \
+             AND transaction_no > COALESCE((SELECT transaction_no FROM snapshots WHERE user_id = users.id), 0))")]
+
+    taken = 0
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        # The write lock keeps trades from landing between reading the ledger and users.cash
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            taken += sum(_checkpoint(db, userID) for userID in user_ids[start:start + BATCH_SIZE])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    return taken
+
+
+def _checkpoint(db, user_id):
+    """Snapshot one user inside the caller's transaction, returning whether there was anything new."""
+    snapshot = db.execute("SELECT transaction_no FROM snapshots WHERE user_id=?", user_id)
+    since = snapshot[0]["transaction_no"] if snapshot else 0
+    tail = db.execute("SELECT transaction_no, user_id, stock_symbol, shares_count, cost, time FROM transactions \
+                      WHERE user_id=? AND transaction_no > ? ORDER BY transaction_no", user_id, since)
+    if not tail:
+        return False
+
+    positions = holdings.replay(tail, _snapshot_positions(db, user_id))
+
+    # Every change to cash is in the ledger, so with the write lock held users.cash is the balance after the tail
+    cash = db.execute("SELECT cash FROM users WHERE id=?", user_id)[0]["cash"]
+    db.execute("INSERT OR REPLACE INTO snapshots (user_id, transaction_no, time, cash) VALUES(?, ?, ?, ?)",
+               user_id, tail[-1]["transaction_no"], tail[-1]["time"], cash)
+
+    db.execute("DELETE FROM snapshot_positions WHERE user_id=?", user_id)
+    if positions:
+        values = ", ".join(["(?, ?, ?, ?, ?)"] * len(positions))
+        parameters = [value for (userID, symbol), position in positions.items() for value in (userID, symbol, *position)]
+        db.execute(f"INSERT INTO snapshot_positions (user_id, symbol, shares, cost_basis, realized) VALUES {values}",
+                   *parameters)
+    return True
+
+
+def _snapshot_positions(db, user_id):
+    """Return the user's positions as of their snapshot, keyed like holdings.replay()."""
+    return {(user_id, row["symbol"]): [row["shares"], row["cost_basis"], row["realized"]] for row in
+            db.execute("SELECT symbol, shares, cost_basis, realized FROM snapshot_positions WHERE user_id=?", user_id)}
+
+
+def verify_cash(db):
+    """Compare each snapshotted user's cash with their snapshot plus the transactions since, returning mismatches."""
+    mismatches = []
+    for snapshot in db.execute("SELECT snapshots.user_id, transaction_no, snapshots.cash, users.cash balance \
+                               FROM snapshots JOIN users ON users.id = snapshots.user_id ORDER BY snapshots.user_id"):
+        tail = db.execute("SELECT stock_symbol, shares_count, cost FROM transactions WHERE user_id=? AND transaction_no > ?",
+                          snapshot["user_id"], snapshot["transaction_no"])
+        expected = snapshot["cash"] + sum(map(cash_change, tail))
+        if expected != snapshot["balance"]:
+            mismatches.append(f"user {snapshot['user_id']}: ledger has {Money(expected)} cash, "
+                              f"users has {Money(snapshot['balance'])}")
+    return mismatches
+
+
+def archive(db, before):
+    """
+    Move each user's transactions dated before the given day, up to the
+    first one that isn't, out of the live ledger, returning how many moved.
+
+    The rows are kept, compressed, in ledger_archive and still appear in
+    exports. ledger_openings records each user's cash and shares just after
+    their last archived transaction, which the portfolio value chart starts
+    from. Each user is checkpointed first, so their snapshot already covers
+    everything archived.
+    """
+    user_ids = [row["user_id"] for row in db.execute("SELECT DISTINCT user_id FROM transactions WHERE time < ?", before)]
+
+    moved = 0
+    for start in range(0, len(user_ids), BATCH_SIZE):
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for userID in user_ids[start:start + BATCH_SIZE]:
+                _checkpoint(db, userID)
+                moved += _archive(db, userID, before)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    return moved
+
+
+def _archive(db, user_id, before):
+    """Archive one user's transactions before the given day inside the caller's transaction."""
+    # Archive whole prefixes of the ledger, so what's left replays on top of the opening balance. Imported
+    # statements can put old-dated rows after newer ones, so the prefix stops at the first row that isn't
+    # before the day, and anything dated earlier after that stays in the live ledger.
+    first = db.execute("SELECT MIN(transaction_no) first FROM transactions WHERE user_id=? AND time >= ?",
+                       user_id, before)[0]["first"]
+    if first is None:
+        last = db.execute("SELECT MAX(transaction_no) last FROM transactions WHERE user_id=?", user_id)[0]["last"]
+    else:
+        last = db.execute("SELECT MAX(transaction_no) last FROM transactions WHERE user_id=? AND transaction_no < ?",
+                          user_id, first)[0]["last"]
+    if last is None:
+        return 0
+
+    # Carry the shares held forward from any earlier opening
+    opening = db.execute("SELECT shares FROM ledger_openings WHERE user_id=?", user_id)
+    shares = json.loads(opening[0]["shares"]) if opening else {}
+
+    # Compress the prefix a chunk at a time, so only one chunk is ever in memory
+    moved = 0
+    since = 0
+    while True:
+        chunk = db.execute("SELECT transaction_no, stock_symbol, shares_count, cost, time FROM transactions \
+                           WHERE user_id=? AND transaction_no > ? AND transaction_no <= ? ORDER BY transaction_no LIMIT ?",
+                           user_id, since, last, ARCHIVE_CHUNK)
+        if not chunk:
+            break
+        for row in chunk:
+            if row["stock_symbol"] != "DEPOSIT":
+                shares[row["stock_symbol"]] = shares.get(row["stock_symbol"], 0) + row["shares_count"]
+        data = zlib.compress(json.dumps([[row["transaction_no"], row["stock_symbol"], row["shares_count"], row["cost"],
+                                          row["time"]] for row in chunk]).encode(), 9)
+        db.execute("INSERT INTO ledger_archive (user_id, first_no, last_no, rows, data) VALUES(?, ?, ?, ?, ?)",
+                   user_id, chunk[0]["transaction_no"], chunk[-1]["transaction_no"], len(chunk), data)
+        moved += len(chunk)
+        since = chunk[-1]["transaction_no"]
+        lastTime = chunk[-1]["time"]
+    shares = {symbol: count for symbol, count in shares.items() if count}
+
+    # Cash after the last archived row is today's balance less whatever came after it
+    after = db.execute("SELECT stock_symbol, shares_count, cost FROM transactions WHERE user_id=? AND transaction_no > ?",
+                       user_id, last)
+    cash = db.execute("SELECT cash FROM users WHERE id=?", user_id)[0]["cash"] - sum(map(cash_change, after))
+    db.execute("INSERT OR REPLACE INTO ledger_openings (user_id, transaction_no, time, cash, shares) VALUES(?, ?, ?, ?, ?)",
+               user_id, last, lastTime, cash, json.dumps(shares))
+
+    db.execute("DELETE FROM transactions WHERE user_id=? AND transaction_no <= ?", user_id, last)
+    return moved
+
+
+def unpack(data):
+    """Return the transactions in one compressed chunk of ledger_archive, as dicts like the ledger's rows."""
+    return [{"transaction_no": number, "stock_symbol": symbol, "shares_count": shares, "cost": cost, "time": time}
+            for number, symbol, shares, cost, time in json.loads(zlib.decompress(data))]
@@ -0,0 +1,317 @@
+import csv
+import re
+import sqlite3
+
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+
+import holdings
+from money import Money
+
+# Rows written per executemany() call while importing
+IMPORT_CHUNK = 5000
+
+# Header names accepted for each column of a CSV statement, lowercase; the first four are what /history/export writes
+CSV_COLUMNS = {
+    "time": ["time", "date", "trade date", "datetime"],
+    "symbol": ["symbol", "ticker"],
+    "shares": ["shares", "quantity", "qty"],
+    "price": ["price", "unit price"],
+    "action": ["action", "type", "side"],
+    "amount": ["amount"],
+}
+
+# Words in a CSV statement's action column meaning a purchase, a sale or a deposit
+BUY_ACTIONS = {"buy", "bought", "b"}
+SELL_ACTIONS = {"sell", "sold", "s"}
+DEPOSIT_ACTIONS = {"deposit", "dep", "credit"}
+
+# One element of an OFX file; leaf elements may have no closing tag in the older SGML form
+OFX_ELEMENT = re.compile(r"<(/?)([A-Za-z0-9.]+)>([^<]*)")
+
+# Characters read from an OFX file at a time
+OFX_BLOCK = 64 * 1024
+
+
+class StatementError(Exception):
+    """A statement that can't be imported; the message says where and why, and is meant for the user."""
+
+
+def import_statement(path, user_id, file, filename, symbols):
+    """
+    Add the trades and deposits in a brokerage statement to the user's
+    ledger, returning how many were added.
+
+    file is an open text file, read as OFX if filename ends in .ofx or .qfx
+    and as CSV otherwise. Every row is checked as it is read: symbols must be
+    in symbols (the local symbol list), rows must be in date order, sales
+    can't exceed the shares held and no purchase can cost more than the
+    user's cash at that point. Rows are written in chunks as they pass, all inside one
+    transaction, so a statement goes in whole or not at all, and the user's
+    cash, holdings and ledger snapshot are written once at the end. Memory
+    use doesn't grow with the length of the statement.
+    """
+    if not len(symbols):
+        raise StatementError("The symbol list is empty; run flask refresh-symbols first.")
+    if filename.lower().endswith((".ofx", ".qfx")):
+        rows = read_ofx(file)
+    else:
+        rows = read_csv(file)
+
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        # Take the write lock up front so no trade lands between reading the user's cash and writing it back
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # The trigger counting ledger changes skips users in ledger_imports, so the user's row isn't
+            # rewritten for every row imported; the count is raised once instead, and the user taken out
+            # again before anyone else can see them there
+            connection.execute("INSERT INTO ledger_imports (user_id) VALUES (?)", (user_id,))
+            count = _import(connection, user_id, rows, symbols)
+            connection.execute("DELETE FROM ledger_imports WHERE user_id = ?", (user_id,))
+            connection.execute("UPDATE users SET ledger_version = ledger_version + ? WHERE id = ?", (count, user_id))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return count
+    finally:
+        connection.close()
+
+
+def _import(connection, user_id, rows, symbols):
+    """Validate and write rows inside the caller's transaction, returning how many were written."""
+    row = connection.execute("SELECT cash FROM users WHERE id = ?", (user_id,)).fetchone()
+    if row is None:
+        raise StatementError(f"There is no user {user_id}.")
+    cash = row[0]
+
+    # The statement's rows come after every transaction already in the ledger, so they replay on top of the holdings
+    positions = {(user_id, symbol): [shares, costBasis, realized] for symbol, shares, costBasis, realized in
+                 connection.execute("SELECT symbol, shares, cost_basis, realized FROM holdings WHERE user_id = ?",
+                                    (user_id,))}
+
+    count = 0
+    chunk = []
+    lastTime = ""
+    for where, time, symbol, shares, cost in rows:
+        if time < lastTime:
+            raise StatementError(f"{where}: the rows must be in date order, oldest first.")
+        lastTime = time
+
+        if symbol == "DEPOSIT":
+            cash += cost
+        else:
+            if symbol not in symbols:
+                raise StatementError(f"{where}: the symbol \"{symbol}\" doesn't exist.")
+            position = positions.get((user_id, symbol))
+            held = position[0] if position else 0
+            if held + shares < 0:
+                raise StatementError(f"{where}: {-shares} {symbol} share(s) sold but only {held} held.")
+            cash -= shares * cost
+            if cash < 0:
+                raise StatementError(f"{where}: the purchase costs {Money(-cash)} more than the cash held.")
+            holdings.replay(({"user_id": user_id, "stock_symbol": symbol, "shares_count": shares, "cost": cost},),
+                            positions)
+
+        chunk.append((user_id, symbol, shares, cost, time))
+        if len(chunk) == IMPORT_CHUNK:
+            count += _write(connection, chunk)
+            chunk = []
+    count += _write(connection, chunk)
+
+    if not count:
+        return 0
+
+    connection.execute("UPDATE users SET cash = ? WHERE id = ?", (cash, user_id))
+    values = [(userID, symbol, *position) for (userID, symbol), position in positions.items()]
+    connection.executemany("INSERT OR REPLACE INTO holdings (user_id, symbol, shares, cost_basis, realized) "
+                           "VALUES (?, ?, ?, ?, ?)", values)
+
+    # Snapshot the user as of the last imported row, so the next checkpoint doesn't replay the whole statement;
+    # the snapshot is dated when it's taken, and the statement's own dates stay on its rows
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    transactionNo = connection.execute("SELECT MAX(transaction_no) FROM transactions WHERE user_id = ?",
+                                       (user_id,)).fetchone()[0]
+    connection.execute("INSERT OR REPLACE INTO snapshots (user_id, transaction_no, time, cash) VALUES (?, ?, ?, ?)",
+                       (user_id, transactionNo, now, cash))
+    connection.execute("DELETE FROM snapshot_positions WHERE user_id = ?", (user_id,))
+    connection.executemany("INSERT INTO snapshot_positions (user_id, symbol, shares, cost_basis, realized) "
+                           "VALUES (?, ?, ?, ?, ?)", values)
+    return count
+
+
+def _write(connection, chunk):
+    """Insert a chunk of ledger rows, returning how many there were."""
+    connection.executemany("INSERT INTO transactions (user_id, stock_symbol, shares_count, cost, time) "
+                           "VALUES (?, ?, ?, ?, ?)", chunk)
+    return len(chunk)
+
+
+def read_csv(file):
+    """
+    Yield (where, time, symbol, shares, price or amount in cents) for each
+    row of a CSV statement.
+
+    Columns are found by their header (see CSV_COLUMNS), so the files
+    written by /history/export can be read back. Shares are signed, or
+    given a sign by an action column of buy or sell; a deposit has the
+    symbol DEPOSIT or the action deposit, and its amount in the amount or
+    price column.
+    """
+    reader = csv.reader(file)
+    header = [name.strip().lower() for name in next(reader, [])]
+    columns = {}
+    for column, names in CSV_COLUMNS.items():
+        for name in names:
+            if name in header:
+                columns[column] = header.index(name)
+                break
+    if "time" not in columns or "symbol" not in columns and "action" not in columns:
+        raise StatementError("The statement needs a date column and a symbol or action column.")
+
+    # Positions of the time column and those _trade() takes, in order, or past the end of any row if missing
+    indexes = [columns.get(column, len(header)) for column in ["time", "action", "symbol", "shares", "price", "amount"]]
+    for row in reader:
+        if not any(row):
+            continue
+        where = f"Line {reader.line_num}"
+        time, *fields = [row[index].strip() if index < len(row) else "" for index in indexes]
+        try:
+            yield where, _time(time), *_trade(*fields)
+        except ValueError as e:
+            raise StatementError(f"{where}: {e}") from None
+
+
+def read_ofx(file):
+    """
+    Yield (where, time, symbol, shares, price or amount in cents) for each
+    stock trade and cash credit in an OFX or QFX statement.
+
+    OFX names the securities in its trades by CUSIP and lists their ticker
+    symbols separately, after the trades, so the file is read twice: once
+    for the tickers and once for the trades. Commissions and fees are left
+    out, as the ledger has nowhere to put them.
+    """
+    tickers = {}
+    securityID = None
+    for tag, value in _ofx_elements(file):
+        if tag == "UNIQUEID":
+            securityID = value
+        elif tag == "TICKER":
+            tickers[securityID] = value.upper()
+    file.seek(0)
+
+    number = 0
+    transaction = None
+    for tag, value in _ofx_elements(file):
+        if tag in ["BUYSTOCK", "SELLSTOCK", "STMTTRN"]:
+            transaction = {}
+        elif tag in ["/BUYSTOCK", "/SELLSTOCK", "/STMTTRN"] and transaction is not None:
+            number += 1
+            where = f"Transaction {number}"
+            try:
+                if tag == "/STMTTRN":
+                    amount = Decimal(transaction.get("TRNAMT", ""))
+                    if amount <= 0:
+                        raise ValueError("only deposits of cash can be imported")
+                    yield where, _time(transaction.get("DTPOSTED", "")), *_trade("deposit", "", "", "", str(amount))
+                else:
+                    symbol = tickers.get(transaction.get("UNIQUEID"))
+                    if symbol is None:
+                        raise ValueError(f"no ticker symbol for security {transaction.get('UNIQUEID')}")
+                    yield (where, _time(transaction.get("DTTRADE", "")),
+                           *_trade("buy" if tag == "/BUYSTOCK" else "sell", symbol, transaction.get("UNITS", ""),
+                                   transaction.get("UNITPRICE", ""), ""))
+            except (ValueError, InvalidOperation) as e:
+                raise StatementError(f"{where}: {e}") from None
+            transaction = None
+        elif transaction is not None and not tag.startswith("/"):
+            transaction[tag] = value
+
+
+def _ofx_elements(file):
+    """Yield (tag, text) for each element of an OFX file, and ("/TAG", "") for each closing tag."""
+    buffer = ""
+    for block in iter(lambda: file.read(OFX_BLOCK), ""):
+        buffer += block
+
+        # The element after the last "<" may continue in the next block
+        cut = buffer.rfind("<")
+        for match in OFX_ELEMENT.finditer(buffer, 0, cut):
+            yield match.group(1) + match.group(2).upper(), match.group(3).strip()
+        buffer = buffer[cut:]
+    for match in OFX_ELEMENT.finditer(buffer):
+        yield match.group(1) + match.group(2).upper(), match.group(3).strip()
+
+
+def _trade(action, symbol, shares, price, amount):
+    """Return (symbol, signed shares, cost in cents) for one row, raising ValueError if it makes no sense."""
+    action = action.lower()
+    symbol = symbol.upper()
+    if action in DEPOSIT_ACTIONS or symbol == "DEPOSIT":
+        cost = _cents(amount or price)
+        if cost <= 0:
+            raise ValueError("a deposit must be of a positive amount")
+        return "DEPOSIT", 0, cost
+
+    if not symbol:
+        raise ValueError("no symbol")
+    try:
+        count = Decimal(shares.replace(",", ""))
+    except InvalidOperation:
+        raise ValueError(f"not a number of shares: {shares!r}")
+    if count != count.to_integral_value():
+        raise ValueError(f"fractional shares can't be imported: {shares!r}")
+    count = int(count)
+    if action in BUY_ACTIONS:
+        count = abs(count)
+    elif action in SELL_ACTIONS:
+        count = -abs(count)
+    elif action:
+        raise ValueError(f"unknown action {action!r}")
+    if not count:
+        raise ValueError("no shares")
+
+    cost = _cents(price)
+    if cost <= 0:
+        raise ValueError(f"not a price: {price!r}")
+    return symbol, count, cost
+
+
+def _cents(text):
+    """Convert a dollar amount from a statement to cents, rounding to the nearest cent."""
+    try:
+        return Money.from_dollars(text.strip().lstrip("$").replace(",", "")).cents
+    except InvalidOperation:
+        raise ValueError(f"not an amount of money: {text!r}")
+
+
+def _time(text):
+    """
+    Convert a statement's date, with or without a time, to the ledger's
+    YYYY-MM-DD HH:MM:SS, moving any time given with an offset from UTC into
+    the server's local time like the rest of the ledger.
+    """
+    # OFX dates are YYYYMMDD[HHMMSS[.XXX]][[offset:zone]], such as 20210814051444.000[-5:EST]
+    match = re.match(r"(\d*)(?:\.\d*)?(?:\[([+-]?\d+(?:\.\d+)?)(?::[^\]]*)?\])?", text)
+    digits, offset = match.group(1), match.group(2)
+    if len(digits) >= 8:
+        digits = digits[:14].ljust(14, "0")
+        text = f"{digits[:4]}-{digits[4:6]}-{digits[6:8]} {digits[8:10]}:{digits[10:12]}:{digits[12:14]}"
+    try:
+        value = datetime.fromisoformat(text)
+        if offset is not None and len(digits) >= 8:
+            value = value.replace(tzinfo=timezone(timedelta(hours=float(offset))))
+
+        # Already in the ledger's form, as in the files /history/export writes
+        if value.tzinfo is None and len(text) == 19 and text[10] == " ":
+            return text
+    except ValueError:
+        try:
+            value = datetime.strptime(text, "%m/%d/%Y")
+        except ValueError:
+            raise ValueError(f"not a date: {text!r}")
+    if value.tzinfo is not None:
+        value = value.astimezone()
+    return value.replace(tzinfo=None).isoformat(" ", "seconds")
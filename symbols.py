@@ -0,0 +1,156 @@
+import threading
+import time
+
+from bisect import bisect_left
+from datetime import datetime
+
+# Rows written per INSERT statement when saving a fresh symbol list
+INSERT_CHUNK = 500
+
+
+class SymbolDirectory:
+    """Every tradable symbol, kept in finance.db and searched by prefix in memory."""
+
+    def __init__(self, db, fetch, max_age=24 * 60 * 60):
+        self.db = db
+        self.max_age = max_age
+        self._fetch = fetch
+        self._lock = threading.Lock()
+
+        # Parallel sorted lists of symbols and company names
+        self._symbols = []
+        self._names = []
+        self._loaded_at = 0
+
+        self.load()
+
+    def load(self):
+        """Read the saved symbol list from the database into the prefix index."""
+        rows = self.db.execute("SELECT symbol, name, updated FROM symbols ORDER BY symbol")
+
+        # Swap both lists at once so searches never see half an update
+        with self._lock:
+            self._symbols = [row["symbol"] for row in rows]
+            self._names = [row["name"] for row in rows]
+            self._loaded_at = _timestamp(rows[0]["updated"]) if rows else 0
+
+    def refresh(self):
+        """Download the symbol list, save it and rebuild the index."""
+        symbols = self._fetch()
+
+        # Keep the old list if the API is unavailable
+        if not symbols:
+            return False
+
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows = sorted(dict(symbols).items())
+
+        # One transaction keeps every statement on the same connection, which the temporary table belongs to
+        self.db.execute("BEGIN TRANSACTION")
+        try:
+            # Fill a temporary table first; statements this size are slow to prepare, and writing to it
+            # takes no lock on the database, which other workers may be refreshing at the same time
+            self.db.execute("CREATE TEMP TABLE symbols_new (symbol TEXT PRIMARY KEY, name TEXT NOT NULL)")
+            for start in range(0, len(rows), INSERT_CHUNK):
+                chunk = rows[start:start + INSERT_CHUNK]
+                placeholders = ", ".join(["(?, ?)"] * len(chunk))
+                values = [value for symbol, name in chunk for value in (symbol, name)]
+                self.db.execute("INSERT INTO symbols_new (symbol, name) VALUES " + placeholders, *values)
+
+            # Swap the new list in; only this part holds the write lock
+            self.db.execute("DELETE FROM symbols")
+            self.db.execute("INSERT INTO symbols (symbol, name, updated) SELECT symbol, name, ? FROM symbols_new", now)
+            self.db.execute("INSERT OR REPLACE INTO reports (name, computed, rows) VALUES ('symbols', ?, ?)", now, len(rows))
+            self.db.execute("DROP TABLE symbols_new")
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+        with self._lock:
+            self._symbols = [symbol for symbol, name in rows]
+            self._names = [name for symbol, name in rows]
+            self._loaded_at = _timestamp(now)
+        return True
+
+    @property
+    def version(self):
+        """Changes whenever a new symbol list is saved, and is the same in every worker that has loaded it."""
+        return f"{len(self._symbols)}-{int(self._loaded_at)}"
+
+    def refresh_if_stale(self):
+        """
+        Refresh the symbol list if it is older than max_age.
+
+        Every worker runs this job. The first to find the list stale claims
+        the refresh by moving the list's computed time in reports to now
+        inside a write transaction; the others find the claim and load the
+        list it saves instead of downloading their own. A refresh that fails
+        puts the old time back for the next run to try again.
+        """
+        if time.time() - self._loaded_at < self.max_age:
+            return
+
+        claimed = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.db.execute("SELECT computed FROM reports WHERE name = 'symbols'")
+            previous = rows[0]["computed"] if rows else None
+            stale = previous is None or time.time() - _timestamp(previous) >= self.max_age
+            if stale:
+                self.db.execute("INSERT INTO reports (name, computed, rows) VALUES ('symbols', ?, 0) "
+                                "ON CONFLICT (name) DO UPDATE SET computed = excluded.computed", claimed)
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+        # Another worker has refreshed the list, or is doing so, since this one loaded it
+        if not stale:
+            self.load()
+            return
+
+        refreshed = False
+        try:
+            refreshed = self.refresh()
+        finally:
+            if not refreshed:
+                if previous is None:
+                    self.db.execute("DELETE FROM reports WHERE name = 'symbols' AND computed = ?", claimed)
+                else:
+                    self.db.execute("UPDATE reports SET computed = ? WHERE name = 'symbols' AND computed = ?",
+                                    previous, claimed)
+
+    def search(self, prefix, limit=10):
+        """Return up to limit symbols starting with prefix, in alphabetical order."""
+        prefix = prefix.upper()
+        if not prefix:
+            return []
+
+        with self._lock:
+            symbols, names = self._symbols, self._names
+
+        # Matches are contiguous in the sorted list, starting at the insertion point
+        matches = []
+        index = bisect_left(symbols, prefix)
+        while index < len(symbols) and len(matches) < limit and symbols[index].startswith(prefix):
+            matches.append({"symbol": symbols[index], "name": names[index]})
+            index += 1
+        return matches
+
+    def __contains__(self, symbol):
+        with self._lock:
+            symbols = self._symbols
+        index = bisect_left(symbols, symbol)
+        return index < len(symbols) and symbols[index] == symbol
+
+    def __len__(self):
+        return len(self._symbols)
+
+
+def _timestamp(value):
+    """Convert a DATETIME column value to seconds since the epoch."""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp()
+    except (TypeError, ValueError):
+        return 0
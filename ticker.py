@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+
+from money import Money
+
+
+class Subscription:
+    """The price changes waiting to be sent to one viewer, for the symbols they hold."""
+
+    def __init__(self, symbols):
+        self.symbols = frozenset(symbols)
+        self._sent = {}
+        self._pending = {}
+        self._changed = threading.Condition()
+
+    def publish(self, prices):
+        """Queue any of the prices (cents, by symbol) this viewer hasn't seen yet."""
+        with self._changed:
+            for symbol in self.symbols & prices.keys():
+                if self._sent.get(symbol) != prices[symbol]:
+                    self._sent[symbol] = self._pending[symbol] = prices[symbol]
+            if self._pending:
+                self._changed.notify()
+
+    def wait(self, timeout):
+        """Return the prices that changed since the last call, waiting up to timeout seconds for one."""
+        with self._changed:
+            if not self._pending:
+                self._changed.wait(timeout)
+            pending, self._pending = self._pending, {}
+        return pending
+
+
+class PriceTicker:
+    """
+    Poll prices for every symbol someone is watching and fan them out.
+
+    A single background thread looks up the union of all subscribers' symbols
+    once per interval and hands each subscriber the changes for its own
+    symbols, so the number of lookups doesn't grow with the number of viewers.
+    The thread sleeps while nobody is subscribed.
+    """
+
+    def __init__(self, fetch_many, interval=5):
+        self.fetch_many = fetch_many
+        self.interval = interval
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def subscribe(self, symbols):
+        """Start watching symbols, returning the Subscription to wait on for changes."""
+        subscription = Subscription(symbols)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="price-ticker", daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def poll(self):
+        """Look up every watched symbol once and publish the prices to the subscribers."""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        symbols = sorted(set().union(*(subscription.symbols for subscription in subscriptions)))
+        if not symbols:
+            return
+
+        quotes = self.fetch_many(symbols)
+        prices = {symbol: Money.from_dollars(quote["price"]).cents for symbol, quote in quotes.items() if quote}
+        for subscription in subscriptions:
+            subscription.publish(prices)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._subscriptions
+            if idle:
+                # Sleep until someone subscribes again
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            try:
+                self.poll()
+            except Exception:
+                logging.getLogger(__name__).exception("price poll failed")
+            time.sleep(self.interval)
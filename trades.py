@@ -0,0 +1,184 @@
+import random
+import sqlite3
+import time
+
+from datetime import datetime
+
+import holdings
+from money import Money
+
+# Attempts made at a trade while the database is busy with other writers
+RETRIES = 5
+
+# Seconds slept after the first busy attempt, doubled after each one
+BACKOFF = 0.02
+
+
+class TradeError(Exception):
+    """A trade that can't go through; the message is meant for the user."""
+
+
+class InsufficientFunds(TradeError):
+    """The user doesn't have enough cash for the trade."""
+
+
+class InsufficientShares(TradeError):
+    """The user doesn't hold enough shares for the trade."""
+
+
+class OrderClosed(TradeError):
+    """The order being filled has already been filled or cancelled."""
+
+
+def enable_wal(path):
+    """Switch the database file to write-ahead logging so reads don't wait on writers."""
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+    finally:
+        connection.close()
+
+
+def buy(db, user_id, symbol, shares, price):
+    """Pay for shares of symbol at price (Money) and add them to the user's holdings."""
+    return _execute(db, lambda: _buy(db, user_id, symbol, shares, price))
+
+
+def sell(db, user_id, symbol, shares, price):
+    """Take shares of symbol out of the user's holdings and pay out the proceeds at price (Money)."""
+    return _execute(db, lambda: _sell(db, user_id, symbol, shares, price))
+
+
+def fill_order(db, order_id, user_id, symbol, shares, price):
+    """
+    Fill a resting order at price (Money): buy for positive shares, sell for
+    negative ones, and mark the order filled, all in one transaction.
+
+    Raises OrderClosed if the order was cancelled or filled in the meantime.
+    """
+    def trade():
+        # Claim the order first; only an open order can be filled, so it is never filled twice
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if db.execute("UPDATE orders SET status='filled', closed=?, fill_price=? WHERE id=? AND status='open'",
+                      now, price.cents, order_id) != 1:
+            raise OrderClosed("The order is no longer open.")
+
+        if shares > 0:
+            transactionNo = _buy(db, user_id, symbol, shares, price)
+        else:
+            transactionNo = _sell(db, user_id, symbol, -shares, price)
+        db.execute("UPDATE orders SET transaction_no=? WHERE id=?", transactionNo, order_id)
+        return transactionNo
+
+    return _execute(db, trade)
+
+
+def batch(db, user_id, orders):
+    """
+    Carry out several orders together, all of them or none.
+
+    orders is a list of (symbol, shares, price) with at most one order per
+    symbol; positive shares buy and negative shares sell at price (Money).
+    The user's cash has to cover the purchases less the proceeds of the sales.
+    """
+    purchases = [(symbol, shares, price) for symbol, shares, price in orders if shares > 0]
+    sales = [(symbol, -shares, price) for symbol, shares, price in orders if shares < 0]
+    netCost = sum((price * shares for symbol, shares, price in orders), Money(0))
+
+    def trade():
+        # Any sale the user can't make fails the whole batch
+        for symbol, shares, price in sales:
+            if not holdings.remove_shares(db, user_id, symbol, shares, price):
+                raise InsufficientShares("The user does not have enough stocks of type \"" + symbol + ".\"")
+
+        # Settle the basket's cash in one update; a net sale always passes the check
+        if db.execute("UPDATE users SET cash = cash - ? WHERE id=? AND cash >= ?", netCost.cents, user_id, netCost.cents) != 1:
+            raise InsufficientFunds("The user does not have sufficient funds to make the purchases.")
+
+        holdings.add_many(db, user_id, purchases)
+        _record_many(db, user_id, orders)
+
+    return _execute(db, trade)
+
+
+def deposit(db, user_id, amount):
+    """Add amount (Money) to the user's cash."""
+
+    def trade():
+        db.execute("UPDATE users SET cash = cash + ? WHERE id=?", amount.cents, user_id)
+        return _record(db, user_id, "DEPOSIT", 0, amount)
+
+    return _execute(db, trade)
+
+
+def _buy(db, user_id, symbol, shares, price):
+    """Buy shares inside the caller's transaction, returning the transaction number."""
+    cost = (price * shares).cents
+
+    # Only take the cash if the user still has enough of it
+    if db.execute("UPDATE users SET cash = cash - ? WHERE id=? AND cash >= ?", cost, user_id, cost) != 1:
+        raise InsufficientFunds("The user does not have sufficient funds to make the purchase.")
+    holdings.add_shares(db, user_id, symbol, shares, price)
+    return _record(db, user_id, symbol, shares, price)
+
+
+def _sell(db, user_id, symbol, shares, price):
+    """Sell shares inside the caller's transaction, returning the transaction number."""
+
+    # Only sell shares the user still holds
+    if not holdings.remove_shares(db, user_id, symbol, shares, price):
+        raise InsufficientShares("The user does not have enough stocks of type \"" + symbol + ".\"")
+    db.execute("UPDATE users SET cash = cash + ? WHERE id=?", (price * shares).cents, user_id)
+
+    # Make the amount negative as this is a sale
+    return _record(db, user_id, symbol, -shares, price)
+
+
+def _record(db, user_id, symbol, shares, cost):
+    """Add a row to the transactions ledger, returning its transaction number."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return db.execute("INSERT INTO transactions(user_id, stock_symbol, shares_count, cost, time) VALUES(?, ?, ?, ?, ?)",
+                      user_id, symbol, shares, cost.cents, now)
+
+
+def _record_many(db, user_id, orders):
+    """Add a ledger row for each (symbol, shares, price) order with a single INSERT."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    values = ", ".join(["(?, ?, ?, ?, ?)"] * len(orders))
+    parameters = [value for symbol, shares, price in orders for value in (user_id, symbol, shares, price.cents, now)]
+    db.execute(f"INSERT INTO transactions(user_id, stock_symbol, shares_count, cost, time) VALUES {values}", *parameters)
+
+
+def _execute(db, trade):
+    """Run trade inside one write transaction, retrying while the database is busy."""
+    for attempt in range(RETRIES):
+        try:
+            # Take the write lock up front so the checks and writes can't interleave with another trade
+            db.execute("BEGIN IMMEDIATE")
+            result = trade()
+            db.execute("COMMIT")
+            return result
+        except RuntimeError as e:
+            _rollback(db)
+            if not is_busy(e) or attempt == RETRIES - 1:
+                raise
+        except BaseException:
+            _rollback(db)
+            raise
+
+        # Back off a little longer each time, with jitter so retries don't collide
+        time.sleep(BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def _rollback(db):
+    """Roll back the current transaction, if the connection still has one."""
+    try:
+        db.execute("ROLLBACK")
+    except RuntimeError:
+        pass
+
+
+def is_busy(e):
+    """Tell whether an error means another connection holds the lock (SQLITE_BUSY)."""
+    message = str(e).lower()
+    return "locked" in message or "busy" in message